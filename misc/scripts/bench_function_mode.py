@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# compares execution time of a loop-heavy template compiled in module mode
+# (template variables are globals) and in function mode (template variables
+# are fast locals).
+
+import os
+import sys
+import io
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import pycro
+
+TEMPLATE = """\
+//# rows = range(200)
+//# columns = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
+static const char *table[] = {
+//@ for row in rows:
+//@ for column in columns:
+	"${column}${row}", /* $${{ row * len(columns) }} */
+//@ end for
+//@ end for
+};
+"""
+
+def compile_template(function_mode):
+    env = pycro.CompilerEnvironment(
+            language = 'c',
+            function_mode = function_mode,
+            )
+
+    infile = io.StringIO(TEMPLATE)
+    infile.name = '<bench>'
+
+    return pycro.compile_file(infile, env)
+
+def render(code_object):
+    outfile = io.StringIO()
+    pycro.execute_code_object(code_object, outfile, pycro.ExecutorEnvironment())
+    return outfile.getvalue()
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    module_code = compile_template(False)
+    function_code = compile_template(True)
+
+    if render(module_code) != render(function_code):
+        print('error: outputs differ', file=sys.stderr)
+        sys.exit(1)
+
+    for name, code_object in (
+            ('module mode', module_code),
+            ('function mode', function_code),
+            ):
+
+        seconds = min(timeit.repeat(
+                lambda: render(code_object),
+                number = number,
+                repeat = 5,
+                ))
+
+        print('{:<16}{:>10.3f} ms per render'.format(
+                name,
+                seconds * 1000 / number,
+                ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+# sends many small messages, (index, path) tuples like the tasks of compile
+# workers, from a forked producer process to this process. compares
+# multiprocessing.Queue with MarshalQueue & PickleQueue, putting objects one
+# by one and in batches of put_many().
+
+import os
+import sys
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import pycro
+
+BATCH_SIZE = 64
+
+def produce(queue, count, batch_size):
+    if batch_size == 1:
+        for index in range(count):
+            queue.put((index, '/path/to/template-{}.txt'.format(index)))
+
+    else:
+        for start in range(0, count, batch_size):
+            queue.put_many(
+                (index, '/path/to/template-{}.txt'.format(index))
+                for index in range(start, min(start + batch_size, count))
+            )
+
+def consume(queue, count):
+    total = 0
+
+    for _ in range(count):
+        total += queue.get()[0]
+
+    return total
+
+def run(queue_type, count, batch_size):
+    context = multiprocessing.get_context('fork')
+    queue = queue_type()
+
+    start = time.perf_counter()
+
+    producer = context.Process(
+            target = produce,
+            args = (queue, count, batch_size),
+            )
+    producer.start()
+
+    total = consume(queue, count)
+    producer.join()
+
+    seconds = time.perf_counter() - start
+
+    if total != count * (count - 1) // 2:
+        print('error: {} lost messages'.format(queue_type.__name__),
+                file=sys.stderr)
+        sys.exit(1)
+
+    return seconds
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    for name, queue_type, batch_size in (
+            ('multiprocessing', multiprocessing.Queue, 1),
+            ('MarshalQueue', pycro.MarshalQueue, 1),
+            ('PickleQueue', pycro.PickleQueue, 1),
+            ('MarshalQueue batch', pycro.MarshalQueue, BATCH_SIZE),
+            ('PickleQueue batch', pycro.PickleQueue, BATCH_SIZE),
+            ):
+
+        seconds = min(
+                run(queue_type, count, batch_size)
+                for _ in range(5)
+                )
+
+        print('{:<20}{:>10.3f} ms {:>12.0f} messages/s'.format(
+                name,
+                seconds * 1000,
+                count / seconds,
+                ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+# renders many tiny templates, where per-render setup of the executor
+# dominates. compares a new ExecutorEnvironment per render (executor is
+# created on each render), a shared ExecutorEnvironment (executor is created
+# once and reset between renders) and compile_template() render functions.
+
+import os
+import sys
+import io
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import pycro
+
+TEMPLATE = """\
+//# value = {}
+#define VALUE_{} ${{value}}
+"""
+
+def compile_templates(count):
+    env = pycro.CompilerEnvironment(language = 'c')
+
+    code_objects = []
+
+    for index in range(count):
+        infile = io.StringIO(TEMPLATE.format(index, index))
+        infile.name = '<bench-{}>'.format(index)
+
+        code_objects.append(pycro.compile_file(infile, env))
+
+    return env, code_objects
+
+def render_new_env(code_objects):
+    outfile = io.StringIO()
+
+    for code_object in code_objects:
+        pycro.execute_code_object(
+                code_object,
+                outfile,
+                pycro.ExecutorEnvironment(),
+                )
+
+    return outfile.getvalue()
+
+def render_shared_env(code_objects):
+    outfile = io.StringIO()
+    env = pycro.ExecutorEnvironment()
+
+    for code_object in code_objects:
+        pycro.execute_code_object(code_object, outfile, env)
+
+    return outfile.getvalue()
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    env, code_objects = compile_templates(count)
+
+    renders = []
+    for index in range(count):
+        infile = io.StringIO(TEMPLATE.format(index, index))
+        infile.name = '<bench-{}>'.format(index)
+
+        renders.append(pycro.compile_template(infile, env))
+
+    def render_compiled(code_objects):
+        outfile = io.StringIO()
+
+        for render in renders:
+            render(None, outfile)
+
+        return outfile.getvalue()
+
+    expected = render_new_env(code_objects)
+
+    for name, function in (
+            ('new env', render_new_env),
+            ('shared env', render_shared_env),
+            ('compile_template', render_compiled),
+            ):
+
+        if function(code_objects) != expected:
+            print('error: {} output differs'.format(name), file=sys.stderr)
+            sys.exit(1)
+
+        seconds = min(
+                _time(function, code_objects)
+                for _ in range(5)
+                )
+
+        print('{:<20}{:>10.3f} ms per {} templates'.format(
+                name,
+                seconds * 1000,
+                count,
+                ))
+
+def _time(function, code_objects):
+    start = time.perf_counter()
+    function(code_objects)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    main()
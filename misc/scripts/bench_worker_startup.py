@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+# measures startup of render workers, from creating Workers until each worker
+# is ready for jobs. compares cold workers, that import modules & load a
+# large json file by themselves (like '-I MODULE' & '-l JSONFILE' repeated in
+# each worker), and warm workers forked after this process prepared the
+# executor environment once.
+
+import os
+import sys
+import json
+import time
+import tempfile
+import importlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import pycro
+
+MODULES = (
+    'decimal',
+    'fractions',
+    'xml.dom.minidom',
+    'email.mime.multipart',
+    'http.client',
+    'unittest',
+)
+
+def prepare(json_path):
+    env = pycro.ExecutorEnvironment()
+
+    # like '-I MODULE', the top-level package is the variable
+    for name in MODULES:
+        importlib.import_module(name)
+
+        package = name.partition('.')[0]
+        env.variables[package] = sys.modules[package]
+
+    with open(json_path) as json_file:
+        env.variables.update(json.load(json_file))
+
+    return env
+
+# returns startup seconds of each worker
+def start_workers(workers_number, initializer):
+    ready = pycro.MarshalQueue()
+    start = time.monotonic()
+
+    def report():
+        if initializer is not None:
+            initializer()
+
+        ready.put(time.monotonic() - start)
+
+    workers = pycro.Workers({}, workers_number, initializer = report)
+
+    seconds = [ready.get() for _ in range(workers_number)]
+
+    workers.close()
+    ready.release()
+
+    return seconds
+
+def main():
+    workers_number = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    entries = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+
+    with tempfile.TemporaryDirectory() as folder:
+        json_path = os.path.join(folder, 'variables.json')
+
+        with open(json_path, 'w') as json_file:
+            json.dump(
+                {
+                    'key_{}'.format(i): {
+                        'index': i,
+                        'name': 'item {}'.format(i),
+                    }
+                    for i in range(entries)
+                },
+                json_file,
+            )
+
+        # cold runs come first, modules are imported by this process in warm
+        # runs.
+        cold = min(
+                (start_workers(workers_number, lambda: prepare(json_path))
+                    for _ in range(5)),
+                key = max,
+                )
+
+        prepare_seconds = []
+        warm = None
+        for _ in range(5):
+            start = time.perf_counter()
+            env = prepare(json_path)
+            prepare_seconds.append(time.perf_counter() - start)
+
+            seconds = start_workers(workers_number, None)
+            if warm is None or max(seconds) < max(warm):
+                warm = seconds
+
+            del env
+
+    print('{} workers, {} json entries'.format(workers_number, entries))
+
+    for name, seconds in (('cold', cold), ('warm', warm)):
+        print('{:<20}{:>10.3f} ms mean {:>10.3f} ms max per worker'.format(
+                name,
+                sum(seconds) / len(seconds) * 1000,
+                max(seconds) * 1000,
+                ))
+
+    print('{:<20}{:>10.3f} ms once'.format(
+            'warm prepare',
+            min(prepare_seconds) * 1000,
+            ))
+
+if __name__ == '__main__':
+    main()
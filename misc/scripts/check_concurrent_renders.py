@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+# renders templates concurrently with one shared CompilerEnvironment, like a
+# server that renders each request with the same settings. each render must
+# compile its template on its own, so renders can't see the state of others.
+# exits with status 1 if a render fails or returns wrong output.
+
+import os
+import sys
+import asyncio
+import tempfile
+import concurrent.futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import pycro
+
+RENDERS = 40
+
+# blocks of each template, large templates keep compiles running at the same
+# time
+BLOCKS = 200
+
+TEMPLATE = """\
+#@ for i in range(count):
+#@ if i % 2:
+odd ${{i}} of {index}
+#@ end if
+#@ if not i % 2:
+even ${{i}} of {index}
+#@ end if
+#@ end for
+"""
+
+def expected(index, count):
+    return ''.join(
+        '{} {} of {}\n'.format('odd' if i % 2 else 'even', i, index)
+        for i in range(count)
+    )
+
+def write_templates(folder):
+    paths = []
+
+    for index in range(RENDERS):
+        path = os.path.join(folder, 'template-{}.txt'.format(index))
+
+        with open(path, 'w') as template_file:
+            template_file.write(TEMPLATE.format(index = index) * BLOCKS)
+
+        paths.append(path)
+
+    return paths
+
+async def render_async_all(paths, env):
+    return await asyncio.gather(
+        *(pycro.render_async(path, {'count': 5}, compiler_env = env)
+            for path in paths),
+        return_exceptions = True,
+    )
+
+def render_iter_one(path, env):
+    try:
+        return ''.join(pycro.render_iter(path, {'count': 5},
+                compiler_env = env))
+
+    except Exception as e:
+        return e
+
+def render_iter_all(paths, env):
+    with concurrent.futures.ThreadPoolExecutor(RENDERS) as executor:
+        return list(executor.map(
+            lambda path: render_iter_one(path, env),
+            paths,
+        ))
+
+def check(name, results):
+    failures = 0
+
+    for index, result in enumerate(results):
+        if isinstance(result, BaseException):
+            print('{}: render {} failed: {!r}'.format(name, index, result),
+                    file=sys.stderr)
+            failures += 1
+
+        elif result != expected(index, 5) * BLOCKS:
+            print('{}: render {} returned wrong output'.format(name, index),
+                    file=sys.stderr)
+            failures += 1
+
+    print('{:<20}{:>4} renders {:>4} failures'.format(
+            name,
+            len(results),
+            failures,
+            ))
+
+    return failures
+
+def main():
+    failures = 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = write_templates(folder)
+
+        env = pycro.CompilerEnvironment(language = 'python')
+        failures += check('render_async', asyncio.run(
+                render_async_all(paths, env)))
+
+        env = pycro.CompilerEnvironment(language = 'python')
+        failures += check('render_iter', render_iter_all(paths, env))
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
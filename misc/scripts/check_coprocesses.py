@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# renders templates that call '__run__' with coprocess = True, in text mode
+# and in bytes mode, for both coprocess protocols. output of a bytes mode
+# render is bytes, so results of coprocesses must be bytes too. exits with
+# status 1 if a render fails or returns wrong output.
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import pycro
+
+# upper-cases each line it reads, until its input is closed
+LINE_COPROCESS = [
+    sys.executable, '-u', '-c',
+    'import sys\n'
+    'for line in sys.stdin:\n'
+    '    sys.stdout.write(line.upper())\n',
+]
+
+# reads requests prefixed by their 4 byte length & upper-cases them
+LENGTH_COPROCESS = [
+    sys.executable, '-u', '-c',
+    'import sys\n'
+    'stdin, stdout = sys.stdin.buffer, sys.stdout.buffer\n'
+    'while True:\n'
+    '    size = stdin.read(4)\n'
+    '    if len(size) < 4:\n'
+    '        break\n'
+    '    data = stdin.read(int.from_bytes(size, "big")).upper()\n'
+    '    stdout.write(len(data).to_bytes(4, "big") + data)\n'
+    '    stdout.flush()\n',
+]
+
+TEMPLATE = """\
+## __divert__('request')
+hello ${{name}}
+## __divert__()
+before
+## __run__(command, stdin = 'request', coprocess = True, protocol = '{}')
+## __run__(command, stdin = 'request', coprocess = True, protocol = '{}')
+after
+"""
+
+def render(path, protocol, bytes_mode):
+    env = pycro.CompilerEnvironment(
+            language = 'python',
+            bytes_mode = bytes_mode,
+            )
+
+    executor_env = pycro.ExecutorEnvironment(
+            compiler_env = env,
+            bytes_mode = bytes_mode,
+            run_cache = False,
+            )
+
+    command = LINE_COPROCESS if protocol == 'line' else LENGTH_COPROCESS
+
+    try:
+        render_template = pycro.compile_template(path, env, executor_env)
+        return render_template({'command': command, 'name': 'world'})
+
+    finally:
+        executor_env.close()
+
+def main():
+    failures = 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        for protocol in ('line', 'length'):
+            path = os.path.join(folder, '{}.txt'.format(protocol))
+
+            with open(path, 'w') as template_file:
+                template_file.write(TEMPLATE.format(protocol, protocol))
+
+            for bytes_mode in (False, True):
+                name = '{} {}'.format(
+                        protocol,
+                        'bytes' if bytes_mode else 'text',
+                        )
+
+                expected = 'before\nHELLO WORLD\nHELLO WORLD\nafter\n'
+                if bytes_mode:
+                    expected = expected.encode('latin-1')
+
+                try:
+                    output = render(path, protocol, bytes_mode)
+
+                except Exception as e:
+                    print('{}: render failed: {!r}'.format(name, e),
+                            file=sys.stderr)
+                    failures += 1
+                    continue
+
+                if output != expected:
+                    print('{}: wrong output: {!r}'.format(name, output),
+                            file=sys.stderr)
+                    failures += 1
+
+                else:
+                    print('{:<20} ok'.format(name))
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -39,8 +39,20 @@ import importlib
 import json
 import queue
 import multiprocessing
+import concurrent.futures
+import threading
+import asyncio
+import select
+import traceback
+import gc
 import signal
 import pathlib
+import hashlib
+import time
+import ast
+import locale
+import tokenize
+import linecache
 
 # --- version ---
 
@@ -62,6 +74,9 @@ class FileStructError(Exception):
 class CompilerError(Exception):
     pass
 
+class ExecutorError(Exception):
+    pass
+
 # --- exit error code ---
 
 # NOTE: cross-python-version flags
@@ -169,7 +184,12 @@ _VARIABLE_NAME_PATTERN = r'[a-zA-Z_][a-zA-Z_0-9]*'
 _VARIABLE_NAME_RE = re.compile(_VARIABLE_NAME_PATTERN)
 
 _VARIABLE_PATTERN = r'{prefix}(?P<name>{pattern}){suffix}'
-_EVALUATION_PATTERN = r'{prefix}\s*(?P<eval>.*?)\s*{suffix}'
+# spaces around evaluations don't match newlines, so a substitution never
+# spans lines of text.
+_EVALUATION_PATTERN = r'{prefix}[^\S\n]*(?P<eval>.*?)[^\S\n]*{suffix}'
+
+# matches lines that may be macros, statements or comments in bulk mode
+_DIRECTIVE_PATTERN = r'^[ \t]*(?:{prefixes}).*\n?'
 
 
 
@@ -192,6 +212,15 @@ _DEFAULT_RUN_FUNCTION_NAME = '__run__'
 _DEFAULT_INCLUDE_FUNCTION_NAME = '__include__'
 _DEFAULT_PLACE_FUNCTION_NAME = '__place__'
 
+_DEFAULT_LOAD_FUNCTION_NAME = '__load__'
+
+# used by function mode of compiler
+_DEFAULT_TEMPLATE_FUNCTION_NAME = '__template__'
+_DEFAULT_WRITE_VARIABLE_NAME = '__write__'
+
+# used by bytes mode to encode substitutions
+_DEFAULT_ENCODE_FUNCTION_NAME = '__encode__'
+
 _DEFAULT_VERSION_VARIABLE_NAME = '__version__'
 
 _DEFAULT_COMMAND_VARIABLE_NAME = '__command__'
@@ -200,7 +229,7 @@ _DEFAULT_ARGV_VARIABLE_NAME = '__argv__'
 
 # --- other settings ---
 
-_CACHE_FILE_MAGIC_NUMBER = b'.pycroche'
+_CACHE_FILE_MAGIC_NUMBER = b'.pycroch5'
 
 _COMPILE_FLAGS = 0
 _OPTIMIZE_LEVEL = -1
@@ -209,6 +238,59 @@ _MARSHAL_VERSION = 4
 _PICKLE_VERSION = pickle.HIGHEST_PROTOCOL
 
 
+# --- run cache settings ---
+
+_RUN_CACHE_FOLDER_NAME = '.run'
+_RUN_CACHE_MAGIC_NUMBER = b'.pycrorun'
+
+# None means cached results never expire, they are invalidated only by
+# changes of the command, its stdin, its declared input files or by
+# '-C, --clear-cache'.
+_DEFAULT_RUN_CACHE_TTL = None
+
+
+# --- coprocess protocols ---
+
+# 'line':   each request is written as one line to stdin of the helper
+#           process, and one line is read back from its stdout.
+# 'length': each request & response is a _SIZE_LEN byte big-endian length
+#           followed by that many utf-8 encoded bytes.
+
+_LINE_PROTOCOL = 'line'
+_LENGTH_PROTOCOL = 'length'
+
+_COPROCESS_CLOSE_TIMEOUT = 5
+
+
+# --- chunked output settings ---
+
+# outputs that are handed off in chunks (e.g. to async writers) send a chunk
+# once this many characters (bytes in bytes mode) are written.
+_DEFAULT_OUTPUT_CHUNK_SIZE = 1 << 16
+
+# chunks that render_iter() keeps before the render waits for the consumer
+_DEFAULT_PENDING_CHUNKS = 4
+
+
+# --- json loader settings ---
+
+_JSON_CHUNK_SIZE = 1 << 16
+_JSON_LINES_EXTENSIONS = ('.jsonl', '.ndjson')
+
+
+# --- output settings ---
+
+# outputs that are not terminals are written in blocks of this size
+_DEFAULT_OUTPUT_BUFFER_SIZE = 1 << 18
+
+_SIZE_SUFFIXES = {
+    '': 1,
+    'k': 1 << 10,
+    'm': 1 << 20,
+    'g': 1 << 30,
+}
+
+
 # --- multiprocessing settings ---
 
 _MULTIPROCESSING_ENABLED = False
@@ -225,8 +307,28 @@ if _MAX_PROCESS_NUMBER <= 0:
         )
     )
 
+# inputs are compiled & rendered serially unless '-j N' is given
+_DEFAULT_JOBS = 1
+
+# inputs are compiled by a pool of workers if there are at least
+# _POOL_MIN_INPUTS of them. small templates are compiled by threads, so
+# os.stat, open & cache writes of files overlap. templates that are
+# _PROCESS_POOL_MIN_SIZE bytes or larger on average are compiled by
+# processes, since compiling them is bound by the GIL.
+_POOL_MIN_INPUTS = 4
+_PROCESS_POOL_MIN_SIZE = 1 << 16
+
+_THREAD_POOL = 'thread'
+_PROCESS_POOL = 'process'
+
+# seconds between checks of dead worker processes
+_POOL_POLL_INTERVAL = 0.5
+
 _SIZE_LEN = 4
 
+# bytes read at once when a pipe is discarded
+_PIPE_READ_SIZE = 1 << 16
+
 # TODO: remove debugging codes on final release
 
 ################################################# debuging codes ###########
@@ -253,7 +355,7 @@ if __debug__:
         file.write(
             '{}{}'.format(
                 sep.join(
-                    repr(obj) for obj in objects,
+                    repr(obj) for obj in objects
                 ),
                 end,
             )
@@ -293,7 +395,8 @@ if __debug__:
                 _ARRANGE_PROCESS_FLAG,
                 _FORCE_FLAG,
                 _RECURSIVE_FLAG,
-                _CLEAR_CACHE_FLAG,):
+                _CLEAR_CACHE_FLAG,
+                _ISOLATE_FLAG,):
             if switchs & flag:
                 switchs &= ~flag
                 print('{}{}'.format(' ' * 4, __bit_flag_name(flag)))
@@ -352,7 +455,7 @@ __islink = os.path.islink
 __exists = os.path.exists
 
 if sys.version_info >= (3, 4):
-    __fullmatch = re._pattern_type.fullmatch
+    __fullmatch = type(_VARIABLE_NAME_RE).fullmatch
 
 else:
     def __fullmatch(pattern, string):
@@ -391,7 +494,7 @@ def _write_pickle_object(outfile, obj):
     _write_size(outfile, len(_buffer))
     outfile.write(_buffer)
 
-def _read_pickle_object(outfile, obj):
+def _read_pickle_object(infile):
     _buffer_size = _read_size(infile)
     _buffer = infile.read(_buffer_size)
     if len(_buffer) != _buffer_size:
@@ -493,36 +596,499 @@ def _read_string(infile):
 
     return _result.decode('utf-8')
 
+# --- pipe operations ---
+
+def _write_all(fd, _buffer):
+    _buffer = memoryview(_buffer)
+    while _buffer:
+        _buffer = _buffer[os.write(fd, _buffer):]
+
+def _read_exactly(fd, size):
+    _buffer = bytearray()
+    while len(_buffer) < size:
+        data = os.read(fd, size - len(_buffer))
+        if not data:
+            raise EOFError("End of file while reading pipe")
+        _buffer += data
+    return bytes(_buffer)
+
 # --- Queue classes ---
 
-def __queue_maker(write_object, read_object):
+# queues are pipes between processes that are forked after the queue is
+# created. each message is a batch of objects, serialized by dumps and
+# prefixed by its _SIZE_LEN byte size:
+#
+#   put(obj) & put_many(objs) write one message, a get reads a whole message
+#   and returns its objects one by one, so sending objects in batches costs
+#   one pipe write & one lock per batch.
+#
+# maxsize > 0 bounds the number of objects that are put but not read by a
+# get. close() writes an empty message, then get raises EOFError in every
+# process once previous messages are read.
+#
+# NOTE: a put blocks while the pipe is full (about 64 KiB on Linux, ~1000
+#       small tuples), so a process must not put more than that before a
+#       reader runs. Workers puts tasks from a thread, after workers started.
+
+def __queue_maker(dumps, loads):
 
     class Queue:
-        def __init__(self):
-            self._lock = multiprocessing.RLock()
-            self._size = multiprocessing.Value(ctypes.c_ulong, 0, lock=False)
-            self._pipe_r, self_pipe_w = _create_pipe()
-
-        def qsize():
-            return self._size.value
-
-        def put(self, obj):
-            with self._lock:
-                self._size.value += 1
-                write_object(self._pipe_w, obj)
-
-        def get(self):
-            with self._lock:
-                if self._size.value:
-                    self._size.value -= 1
-                    return read_object(self,_pipe_r)
-                else:
-                    raise queue.Empty()
+        def __init__(self, maxsize = 0):
+            self._read_lock = multiprocessing.Lock()
+            self._write_lock = multiprocessing.Lock()
+
+            self._size = multiprocessing.Value('Q', 0)
+            self._closed = multiprocessing.Value('b', 0, lock = False)
+
+            self._maxsize = maxsize
+            if maxsize > 0:
+                self._slots = multiprocessing.Semaphore(maxsize)
+
+            else:
+                self._slots = None
+
+            self._pipe_r, self._pipe_w = os.pipe()
+
+            # objects of a read message, local to each process
+            self._pending = collections.deque()
+
+        def qsize(self):
+            return self._size.value + len(self._pending)
+
+        def empty(self):
+            return self.qsize() == 0
+
+        def put(self, obj, block = True, timeout = None):
+            self.put_many((obj,), block, timeout)
+
+        def put_many(self, objs, block = True, timeout = None):
+            objs = list(objs)
+            if not objs:
+                return
+
+            if self._closed.value:
+                raise ValueError("queue is closed")
+
+            if self._slots is not None:
+                if len(objs) > self._maxsize:
+                    raise ValueError("batch is larger than maxsize of queue")
+
+                deadline = None if timeout is None else \
+                        time.monotonic() + timeout
+
+                for acquired in range(len(objs)):
+                    remaining = None if deadline is None else \
+                            max(deadline - time.monotonic(), 0)
+
+                    if not self._slots.acquire(block, remaining):
+                        for _ in range(acquired):
+                            self._slots.release()
+                        raise queue.Full()
+
+            _buffer = dumps(objs)
+
+            with self._write_lock:
+                if self._closed.value:
+                    if self._slots is not None:
+                        for _ in objs:
+                            self._slots.release()
+                    raise ValueError("queue is closed")
+
+                with self._size.get_lock():
+                    self._size.value += len(objs)
+
+                _write_all(
+                    self._pipe_w,
+                    len(_buffer).to_bytes(_SIZE_LEN, 'big', signed = False) +
+                        _buffer,
+                )
+
+        def get(self, block = True, timeout = None):
+            if not self._pending:
+                self._read_message(block, timeout)
+
+            return self._pending.popleft()
+
+        # returns objects of the next message, or pending objects of the
+        # last read message.
+
+        def get_many(self, block = True, timeout = None):
+            if not self._pending:
+                self._read_message(block, timeout)
+
+            objs = list(self._pending)
+            self._pending.clear()
+            return objs
+
+        def _read_message(self, block, timeout):
+            if not block:
+                timeout = 0
+
+            deadline = None if timeout is None else \
+                    time.monotonic() + timeout
+
+            if not self._read_lock.acquire(block, timeout):
+                raise queue.Empty()
+
+            try:
+                if deadline is not None:
+                    readable = select.select(
+                            [self._pipe_r], [], [],
+                            max(deadline - time.monotonic(), 0),
+                            )[0]
+
+                    if not readable:
+                        raise queue.Empty()
+
+                size = int.from_bytes(
+                        _read_exactly(self._pipe_r, _SIZE_LEN),
+                        'big', signed = False)
+
+                if size == 0:
+                    # pass the close message to other processes
+                    with self._write_lock:
+                        _write_all(self._pipe_w, bytes(_SIZE_LEN))
+                    raise EOFError("queue is closed")
+
+                objs = loads(_read_exactly(self._pipe_r, size))
+
+                with self._size.get_lock():
+                    self._size.value -= len(objs)
+
+            finally:
+                self._read_lock.release()
+
+            if self._slots is not None:
+                for _ in objs:
+                    self._slots.release()
+
+            self._pending.extend(objs)
+
+        # reads & drops data of the pipe without blocking, so a writer that
+        # waits for a full pipe goes on. messages are lost, it's only for
+        # queues that are not read anymore.
+        def discard(self):
+            os.set_blocking(self._pipe_r, False)
+
+            try:
+                while os.read(self._pipe_r, _PIPE_READ_SIZE):
+                    pass
+
+            except BlockingIOError:
+                pass
+
+        def close(self):
+            with self._write_lock:
+                if not self._closed.value:
+                    self._closed.value = 1
+                    _write_all(self._pipe_w, bytes(_SIZE_LEN))
+
+        # closes pipes of this process
+        def release(self):
+            os.close(self._pipe_r)
+            os.close(self._pipe_w)
+
     return Queue
 
-MarshalQueue = __queue_maker(_write_marshal_object, _read_marshal_object)
+MarshalQueue = __queue_maker(
+        lambda obj: marshal.dumps(obj, _MARSHAL_VERSION),
+        marshal.loads,
+        )
+
+PickleQueue = __queue_maker(
+        lambda obj: pickle.dumps(obj, _PICKLE_VERSION, fix_imports = False),
+        lambda data: pickle.loads(data, fix_imports = False),
+        )
+
+# --- worker processes ---
+
+# Workers is a pool of processes that are forked once and run jobs until the
+# pool is closed. handlers maps kinds of jobs to functions:
+#
+#   handlers[kind](*job) -> result
+#
+# jobs & results are sent by MarshalQueues, so they are marshal-able objects.
+# handlers, initializer & finalizer are inherited by forking, they aren't
+# pickled. workers are warm started: modules & variables that this process
+# prepared before the pool is created are shared with workers copy-on-write.
+#
+# map() puts jobs into one task queue, largest first if sizes of jobs are
+# given, and each worker takes the next job as soon as it finishes one, so a
+# large job never keeps small jobs waiting behind it. results are yielded in
+# the order of jobs. the first error of a job terminates all workers, and is
+# raised by map() with the traceback of the worker as its cause.
+#
+# initializer() is called in each worker before its first job and
+# finalizer() before the worker exits.
+
+class _WorkerTraceback(Exception):
+    def __str__(self):
+        return self.args[0]
+
+class Workers:
+    def __init__(self,
+            handlers,
+            workers_number = None,
+
+            initializer = None,
+            finalizer = None,
+            ):
+
+        if workers_number is None:
+            workers_number = _MAX_PROCESS_NUMBER
+
+        self._tasks = MarshalQueue()
+        self._results = MarshalQueue()
+
+        # results of other maps than the running one are dropped
+        self._serial = 0
+        self._remaining = 0
+
+        self._feeder = None
+        self._closed = False
+
+        context = multiprocessing.get_context('fork')
+
+        self._processes = [
+            context.Process(
+                target = _worker_main,
+                name = 'pycro worker-{}'.format(i),
+                args = (
+                    self._tasks,
+                    self._results,
+                    handlers,
+                    initializer,
+                    finalizer,
+                ),
+                daemon = True,
+            )
+            for i in range(workers_number)
+        ]
+
+        # objects of this process are moved to the permanent generation of
+        # gc while forking, so collections in workers don't write to the
+        # pages that they share with this process.
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        try:
+            for process in self._processes:
+                process.start()
+
+        finally:
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+
+        else:
+            self.terminate()
+
+    # *** Workers methods ***
+
+    def map(self, kind, jobs, sizes = None):
+        if self._closed:
+            raise ValueError("workers are closed")
+
+        jobs = list(jobs)
+
+        order = range(len(jobs))
+        if sizes is not None:
+            order = sorted(order, key = sizes.__getitem__, reverse = True)
+
+        self._serial += 1
+        self._remaining = len(jobs)
+
+        # tasks are put by a thread, so this process reads results while
+        # workers wait for tasks, a full task pipe never blocks both sides.
+        self._feeder = threading.Thread(
+                target = self._feed,
+                args = ([
+                    (self._serial, index, kind, jobs[index])
+                    for index in order
+                ],),
+                daemon = True,
+                )
+        self._feeder.start()
+
+        return self._iter_results(self._serial, len(jobs))
+
+    def _feed(self, tasks):
+        for task in tasks:
+            if self._closed:
+                return
+
+            try:
+                self._tasks.put(task)
+
+            except ValueError:
+                return
+
+    def _iter_results(self, serial, count):
+        results = {}
+        next_index = 0
+
+        while next_index < count:
+            result_serial, index, ok, payload = self._get_result()
+
+            # errors of initializer have no serial
+            if result_serial is not None and result_serial != serial:
+                continue
+
+            if not ok:
+                self.terminate()
+
+                error, formatted = pickle.loads(payload)
+                raise error from _WorkerTraceback(formatted)
+
+            self._remaining -= 1
+            results[index] = payload
+
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+
+    def _get_result(self):
+        while True:
+            try:
+                return self._results.get(timeout = _POOL_POLL_INTERVAL)
+
+            except queue.Empty:
+                pass
+
+            # workers exit with code 0 after their initializer failed, or
+            # when tasks are closed. a dead worker is an error if it
+            # crashed, or if no worker is left to send results.
+            exited = [
+                process
+                for process in self._processes
+                if process.exitcode is not None
+            ]
+            crashed = [process for process in exited if process.exitcode]
+
+            if not crashed and len(exited) < len(self._processes):
+                continue
+
+            # a worker puts its last result before it exits, e.g. the error
+            # of its initializer.
+            try:
+                return self._results.get(block = False)
+
+            except queue.Empty:
+                pass
+
+            process = (crashed or exited)[0]
+
+            self.terminate()
+            raise FatalError('{} exited with code {}'.format(
+                    process.name,
+                    process.exitcode,
+                    ))
+
+    # waits for workers to exit, workers are terminated if results of a map
+    # are not read.
+    def close(self):
+        if self._closed:
+            return
+
+        if self._remaining or \
+                (self._feeder is not None and self._feeder.is_alive()):
+            self.terminate()
+            return
+
+        self._closed = True
+
+        self._tasks.close()
+        for process in self._processes:
+            process.join()
+
+        self._tasks.release()
+        self._results.release()
+
+    def terminate(self):
+        if self._closed:
+            return
+
+        self._closed = True
+
+        for process in self._processes:
+            process.terminate()
+
+        for process in self._processes:
+            process.join()
+
+        # the feeder may wait for the task pipe, discard tasks until the
+        # feeder sees that workers are closed.
+        if self._feeder is not None and self._feeder.is_alive():
+            deadline = time.monotonic() + _POOL_POLL_INTERVAL
+            while self._feeder.is_alive() and time.monotonic() < deadline:
+                self._tasks.discard()
+                self._feeder.join(_POOL_POLL_INTERVAL / 10)
+
+            # pipes of a blocked feeder are left open
+            if self._feeder.is_alive():
+                return
+
+        self._tasks.release()
+        self._results.release()
+
+# terminated workers exit by SystemExit, so jobs remove their temporary files
+def _exit_worker(signum, frame):
+    sys.exit(128 + signum)
+
+def _worker_main(tasks, results, handlers, initializer, finalizer):
+    signal.signal(signal.SIGTERM, _exit_worker)
+
+    try:
+        if initializer is not None:
+            initializer()
+
+    except Exception as error:
+        results.put((None, None, False, _dump_error(error)))
+        return
+
+    try:
+        while True:
+            try:
+                serial, index, kind, job = tasks.get()
+
+            except EOFError:
+                break
+
+            try:
+                result = handlers[kind](*job)
+
+            except Exception as error:
+                results.put((serial, index, False, _dump_error(error)))
+
+            else:
+                results.put((serial, index, True, result))
+
+    finally:
+        if finalizer is not None:
+            finalizer()
 
-PickleQueue = __queue_maker(_write_pickle_object, _read_pickle_object)
+# pickles error & its formatted traceback, errors that can't be unpickled are
+# sent as RuntimeError.
+
+def _dump_error(error):
+    formatted = ''.join(traceback.format_exception(
+            type(error), error, error.__traceback__)).rstrip('\n')
+
+    try:
+        payload = pickle.dumps((error, formatted), _PICKLE_VERSION)
+        pickle.loads(payload)
+
+    except Exception:
+        payload = pickle.dumps(
+                (RuntimeError(str(error)), formatted), _PICKLE_VERSION)
+
+    return payload
 
 # --- command line help & options ---
 
@@ -540,6 +1106,9 @@ Operation modes:
 Sortable options:
     -D, --define NAME[=VAR]         define NAME variable as having VALUE, or
                                       {default_variable_value}
+    -K, --constant NAME=VALUE       define NAME variable as a constant VALUE,
+                                      '${{NAME}}' substitutions are replaced
+                                      by VALUE at compile time
     -U, --undefine NAME             undefine NAME variable
     -S, --set KEY=VALUE             set KEY setting to VALUE
     -L, --lang LANGUAGE             set prefixes and suffixes for LANGUAGE
@@ -562,8 +1131,18 @@ Common options:
     -r, --recursive                 pycro directories recursively
     -C, --clear-cache               first clear compiler cache
     -d, --dereference               follow symbolic links
+    -i, --isolate                   render each input FILE in its own
+                                      variables, by -j worker processes
     -o, --outfile OUTFILE           set output file to OUTFILE
-    -O, --outfolder OUTFOLDER       set output folder to OUTFOLDER
+    -O, --outfolder OUTFOLDER       set output folder to OUTFOLDER, each
+                                      input FILE is written to a file of
+                                      the same name
+    -B, --buffer-size SIZE          write output in blocks of SIZE bytes,
+                                      SIZE may end with K, M or G
+                                      (default: {default_buffer_size})
+    -j, --jobs N                    compile input FILEs by N threads or
+                                      processes, and render isolated FILEs
+                                      by N processes (default: {default_jobs})
 
 Known language specifications:
 {language_specifications}
@@ -583,11 +1162,34 @@ Setting keys:
 
     ep, evaluation_prefix           evaluation substitution prefix
     es, evaluation_suffix           evaluation substitution suffix
+
+    ii, inline_includes             inline includes of literal file names
+                                      at compile time (boolean)
+    fm, function_mode               compile template body as a function, so
+                                      its variables are fast locals (boolean)
+    pe, partial_evaluation          evaluate statements that only depend on
+                                      literals at compile time (boolean)
+    bm, bytes_mode                  copy template text as bytes, and write
+                                      output in binary (boolean)
+    ck, chunk_size                  compile large templates in chunks of
+                                      about this many characters (size)
+    bk, bulk_mode                   find macros, statements & comments in
+                                      whole template by a regex, and write
+                                      text between them at once (boolean)
+
+Boolean setting values:
+    1, true, yes, on                enable
+    0, false, no, off               disable
+
+Size setting values:
+    N, NK, NM, NG                   N, N * 1024, N * 1024^2, N * 1024^3
 """
 
 def __print_help():
     print(__HELP.format(
             default_variable_value = _DEFAULT_VARIABLE_VALUE,
+            default_buffer_size = _DEFAULT_OUTPUT_BUFFER_SIZE,
+            default_jobs = _DEFAULT_JOBS,
             language_specifications =
                 __prettify_items(sorted(_language_specifications.keys())),
         ),
@@ -604,7 +1206,7 @@ def __print_version():
     print(__VERSION.format(*VERSION))
 
 __setting_keys = {
-    'mp', 'macro_prefix'
+    'mp', 'macro_prefix',
     'ms', 'macro_suffix',
 
     'sp', 'statement_prefix',
@@ -618,6 +1220,13 @@ __setting_keys = {
 
     'ep', 'evaluation_prefix',
     'es', 'evaluation_suffix',
+
+    'ii', 'inline_includes',
+    'fm', 'function_mode',
+    'pe', 'partial_evaluation',
+    'bm', 'bytes_mode',
+    'ck', 'chunk_size',
+    'bk', 'bulk_mode',
 }
 
 _language_specifications = dict(
@@ -692,6 +1301,7 @@ _RECURSIVE_FLAG =           0x02
 _CLEAR_CACHE_FLAG =         0x04
 _FORCE_FLAG =               0x08
 _DEREFERENCE_FLAG =         0x10
+_ISOLATE_FLAG =             0x20
 
 # --- jobs unique flags ---
 
@@ -705,6 +1315,7 @@ _INPUT_FLAG =               0x04
 _DEFINE_FLAG =              0x05
 _UNDEFINE_FLAG =            0x06
 _SETTING_FLAG =             0x07
+_CONSTANT_FLAG =            0x08
 
 # used in __parse_argv:
 _FILTER_NAME_FLAG =         0x0a
@@ -717,6 +1328,10 @@ _IGNORE_PATH_FLAG =         0x0d
 _OUTFILE_FLAG =             0x0e
 _OUTFOLDER_FLAG =           0x0f
 
+# used in __parse_argv:
+_BUFFER_SIZE_FLAG =         0x10
+_JOBS_FLAG =                0x11
+
 # *** argument parser ***
 
 ################################################# debuging codes ###########
@@ -739,6 +1354,9 @@ if __debug__:
         elif flag == _DEREFERENCE_FLAG:
             return '_DEREFERENCE_FLAG'
 
+        elif flag == _ISOLATE_FLAG:
+            return '_ISOLATE_FLAG'
+
         else:
             raise ValueError('unknown flag: {}'.format(flag))
 
@@ -764,6 +1382,9 @@ if __debug__:
         elif flag == _SETTING_FLAG:
             return '_SETTING_FLAG'
 
+        elif flag == _CONSTANT_FLAG:
+            return '_CONSTANT_FLAG'
+
         elif flag == _FILTER_NAME_FLAG:
             return '_FILTER_NAME_FLAG'
 
@@ -782,6 +1403,12 @@ if __debug__:
         elif flag == _OUTFOLDER_FLAG:
             return '_OUTFOLDER_FLAG'
 
+        elif flag == _BUFFER_SIZE_FLAG:
+            return '_BUFFER_SIZE_FLAG'
+
+        elif flag == _JOBS_FLAG:
+            return '_JOBS_FLAG'
+
         else:
             raise ValueError('unknown flag: {}'.format(flag))
 
@@ -797,9 +1424,6 @@ if __debug__:
 
 ################################################# debuging codes ###########
 
-# HACK: some interesting options:
-#       -i, --isolate                   isolate preprocessing each input file
-
 def __parse_argv(argv):
     result = dotdict(
             jobs = collections.deque(),
@@ -813,6 +1437,10 @@ def __parse_argv(argv):
             switchs = 0,
 
             output = None,
+
+            buffer_size = None,
+
+            workers = _DEFAULT_JOBS,
             )
 
     next_args = collections.deque()
@@ -861,7 +1489,38 @@ def __parse_argv(argv):
                 # checked
                 result.output = (_OUTFOLDER_FLAG, arg)
 
-            elif next_arg[0] == _DEFINE_FLAG:
+            elif next_arg[0] == _JOBS_FLAG:
+
+                # --- parsing number of workers ---
+                if not arg.isdigit() or int(arg) <= 0:
+                    __print_error(
+                        "invalid number of jobs: {!r} for option: {!r}".format(
+                            arg,
+                            next_arg[1],
+                        )
+                    )
+                    __print_try(argv[0])
+                    return 1
+
+                result.workers = int(arg)
+
+            elif next_arg[0] == _BUFFER_SIZE_FLAG:
+
+                # --- parsing buffer size ---
+                try:
+                    result.buffer_size = __parse_size(arg)
+
+                except ValueError as e:
+                    __print_error(
+                        "{} for option: {!r}".format(
+                            e.args[0],
+                            next_arg[1],
+                        )
+                    )
+                    __print_try(argv[0])
+                    return 1
+
+            elif next_arg[0] in (_DEFINE_FLAG, _CONSTANT_FLAG):
 
                 # --- parsing definition ---
                 arg = arg.split('=', maxsplit=1)
@@ -885,7 +1544,7 @@ def __parse_argv(argv):
                     __print_try(argv[0])
                     return 1
 
-                result.jobs.append((_DEFINE_FLAG, arg))
+                result.jobs.append((next_arg[0], arg))
 
             elif next_arg[0] == _UNDEFINE_FLAG:
 
@@ -1027,6 +1686,10 @@ def __parse_argv(argv):
                 elif option == 'dereference':
                     result.switchs |= _DEREFERENCE_FLAG
 
+                # isolate input files
+                elif option == 'isolate':
+                    result.switchs |= _ISOLATE_FLAG
+
                 # set output file
                 elif option == 'outfile':
                     if has_output:
@@ -1045,10 +1708,22 @@ def __parse_argv(argv):
                     next_args.append((_OUTFOLDER_FLAG, '--outfolder'))
                     has_output = True
 
+                # set output buffer size
+                elif option == 'buffer-size':
+                    next_args.append((_BUFFER_SIZE_FLAG, '--buffer-size'))
+
+                # set number of workers
+                elif option == 'jobs':
+                    next_args.append((_JOBS_FLAG, '--jobs'))
+
                 # define variable
                 elif option == 'define':
                     next_args.append((_DEFINE_FLAG, '--define'))
 
+                # define constant
+                elif option == 'constant':
+                    next_args.append((_CONSTANT_FLAG, '--constant'))
+
                 # undefine variable
                 elif option == 'undefine':
                     next_args.append((_UNDEFINE_FLAG, '--undefine'))
@@ -1122,6 +1797,10 @@ def __parse_argv(argv):
                     elif ch == 'd':
                         result.switchs |= _DEREFERENCE_FLAG
 
+                    # isolate input files
+                    elif ch == 'i':
+                        result.switchs |= _ISOLATE_FLAG
+
                     # set output file
                     elif ch == 'o':
                         if has_output:
@@ -1140,10 +1819,22 @@ def __parse_argv(argv):
                         next_args.append((_OUTFOLDER_FLAG, '-O'))
                         has_output = True
 
+                    # set output buffer size
+                    elif ch == 'B':
+                        next_args.append((_BUFFER_SIZE_FLAG, '-B'))
+
+                    # set number of workers
+                    elif ch == 'j':
+                        next_args.append((_JOBS_FLAG, '-j'))
+
                     # define variable
                     elif ch == 'D':
                         next_args.append((_DEFINE_FLAG, '-D'))
 
+                    # define constant
+                    elif ch == 'K':
+                        next_args.append((_CONSTANT_FLAG, '-K'))
+
                     # undefine variable
                     elif ch == 'U':
                         next_args.append((_UNDEFINE_FLAG, '-U'))
@@ -1161,7 +1852,7 @@ def __parse_argv(argv):
                         next_args.append((_JSONFILE_FLAG, '-l'))
 
                     # import module
-                    elif ch == 'i':
+                    elif ch == 'I':
                         next_args.append((_IMPORT_FLAG, '-I'))
 
                     else:
@@ -1200,6 +1891,7 @@ _MACRO_REQUIRES = 1
 _WITHOUT_PRECEDING = 2
 _END_DOES_NOT_MATCH = 3
 _UNTERMINATED_BLOCK = 4
+_INCLUDE_CYCLE = 5
 
 # *** macros ***
 
@@ -1357,13 +2049,28 @@ def _generate_end(args, outfile, env):
 
 def _generate_divert(args, outfile, env):
     outfile.write(
-        '{}{}({})\n'.format(
+        '{}{}({}){}\n'.format(
             env.tabs(),
             env.divert_function_name,
-            args
+            args,
+            _bind_write(env),
         )
     )
 
+# in function mode, outfile.write is bound to a local variable, so it must be
+# bound again after anything that may change outfile. it's appended to the
+# line of that statement, so lines of generated code stay the lines of the
+# template.
+
+def _bind_write(env):
+    if env.function_mode:
+        return '; {} = {}.write'.format(
+                env.write_variable_name,
+                env.outfile_variable_name,
+                )
+
+    return ''
+
 # -- undivert macro ---
 
 def _generate_undivert(args, outfile, env):
@@ -1391,17 +2098,31 @@ def _generate_place(args, outfile, env):
 
 # --- include macro ---
 
-# TODO: complete _generator_include()
-
 def _generate_include(args, outfile, env):
     if not args:
-        raise CompilerError(_MACRO_REQUIRES, 'for', 'a filename')
+        raise CompilerError(_MACRO_REQUIRES, 'include', 'a filename')
+
+    # --- inline literal file names ---
+
+    if env.inline_includes:
+        try:
+            file_name = ast.literal_eval(args)
+
+        except (ValueError, SyntaxError):
+            file_name = None
+
+        if isinstance(file_name, str):
+            _inline_include(file_name, outfile, env)
+            return
+
+    env.static_text = None
 
     outfile.write(
-        '{}{}({})\n'.format(
+        '{}{}({}){}\n'.format(
             env.tabs(),
             env.include_function_name,
             args,
+            _bind_write(env),
         )
     )
 
@@ -1422,10 +2143,17 @@ def _generate_run(args, outfile, env):
 
 # --- load macro ---
 
-# TODO: write _generate_load()
-
 def _generate_load(args, outfile, env):
-    pass
+    if not args:
+        raise CompilerError(_MACRO_REQUIRES, 'load', 'a filename')
+
+    outfile.write(
+        '{}{}({})\n'.format(
+            env.tabs(),
+            env.load_function_name,
+            args,
+        )
+    )
 
 _default_code_generators = {
         'if': _generate_if,
@@ -1449,31 +2177,228 @@ _default_code_generators = {
         'undivert': _generate_undivert,
 
         'place': _generate_place,
-
-        # TODO: add 'include' when ready
+        'include': _generate_include,
 
         'run': _generate_run,
 
-        # TODO: add 'load' when ready
+        'load': _generate_load,
 }
 
-# --- compiler environment & functions ---
+# --- matchers ---
 
-class CompilerEnvironment:
-    def __init__(
-            self,
+# compiled regexes are shared by every environment with the same macros,
+# prefixes & suffixes. the registry is filled before workers are forked, so
+# they inherit the compiled regexes.
 
-            code_generators = None,
+_matchers = {}
 
-            # --- suffixes & prefixes ---
-            macro_prefix = '@',
-            macro_suffix = '',
+def _get_matchers(key):
+    try:
+        return _matchers[key]
 
-            statement_prefix = '#',
-            statement_suffix = '',
+    except KeyError:
+        pass
 
-            comment_prefix = '%',
-            comment_suffix = '',
+    (
+        macros,
+        macro_prefix,
+        statement_prefix,
+        comment_prefix,
+        variable_prefix,
+        variable_suffix,
+        evaluation_prefix,
+        evaluation_suffix,
+    ) = key
+
+    if (not variable_prefix) or (not variable_suffix):
+        raise ValueError(
+                "variable_prefix & variable_suffix can't be empty")
+
+    if (not evaluation_prefix) or (not evaluation_suffix):
+        raise ValueError(
+                "evaluation_prefix & evaluation_suffix can't be empty")
+
+    matchers = dotdict(
+
+        macro_re = re.compile(
+            _MACRO_PATTERN.format(
+                macros = '|'.join(macros),
+            )
+        ),
+
+        evaluation_variable_re = re.compile(
+            _EVALUATION_PATTERN.format(
+                prefix = re.escape(evaluation_prefix),
+                suffix = re.escape(evaluation_suffix),
+            ) + '|' +
+
+            _VARIABLE_PATTERN.format(
+                prefix = re.escape(variable_prefix),
+                pattern = _VARIABLE_NAME_PATTERN,
+                suffix = re.escape(variable_suffix),
+            )
+        ),
+
+        directive_re = re.compile(
+            _DIRECTIVE_PATTERN.format(
+                prefixes = '|'.join(
+                    re.escape(prefix)
+                    for prefix in (
+                        macro_prefix,
+                        statement_prefix,
+                        comment_prefix,
+                    )
+                ),
+            ),
+            re.MULTILINE,
+        ),
+    )
+
+    _matchers[key] = matchers
+
+    return matchers
+
+# --- compiler config ---
+
+# CompilerConfig is a frozen snapshot of CompilerEnvironment settings. it's
+# hashable (as long as constant values are), so it can be used as a key, and
+# it can be shared between threads; each compile gets its own environment by
+# config.environment().
+
+_COMPILER_CONFIG_FIELDS = (
+    'code_generators',
+
+    'macro_prefix',
+    'macro_suffix',
+    'statement_prefix',
+    'statement_suffix',
+    'comment_prefix',
+    'comment_suffix',
+    'variable_prefix',
+    'variable_suffix',
+    'evaluation_prefix',
+    'evaluation_suffix',
+
+    'tab',
+    'indent',
+
+    'outfile_variable_name',
+    'pipes_varaible_name',
+    'divert_function_name',
+    'undivert_function_name',
+    'run_function_name',
+    'include_function_name',
+    'place_function_name',
+    'load_function_name',
+    'template_function_name',
+    'write_variable_name',
+    'encode_function_name',
+
+    'compile_flags',
+    'optimize_level',
+
+    'inline_includes',
+    'function_mode',
+    'partial_evaluation',
+    'bytes_mode',
+    'chunk_size',
+    'bulk_mode',
+
+    'constants',
+)
+
+class CompilerConfig(
+        collections.namedtuple('CompilerConfig', _COMPILER_CONFIG_FIELDS)):
+
+    __slots__ = ()
+
+    # code_generators & constants are tuples of (name, value) items
+
+    def environment(self):
+        return CompilerEnvironment.from_config(self)
+
+    # settings that change the compiled code, written to cache files
+
+    def cache_key(self):
+        return _cache_key(self, self.code_generators, self.constants)
+
+# returns the cache key of settings of a CompilerConfig or a
+# CompilerEnvironment, code_generators & constants are their (name, value)
+# items. returns None if a code generator is not a default one: functions
+# can't be compared between processes, so their code is never cached.
+
+def _cache_key(settings, code_generators, constants):
+    names = []
+
+    for name, code_generator in code_generators:
+        if _default_code_generators.get(name) is not code_generator:
+            return None
+
+        names.append(name)
+
+    return (
+        tuple(sorted(names)),
+
+        settings.macro_prefix,
+        settings.macro_suffix,
+        settings.statement_prefix,
+        settings.statement_suffix,
+        settings.comment_prefix,
+        settings.comment_suffix,
+        settings.variable_prefix,
+        settings.variable_suffix,
+        settings.evaluation_prefix,
+        settings.evaluation_suffix,
+
+        settings.tab,
+        settings.indent,
+
+        settings.outfile_variable_name,
+        settings.pipes_varaible_name,
+        settings.divert_function_name,
+        settings.undivert_function_name,
+        settings.run_function_name,
+        settings.include_function_name,
+        settings.place_function_name,
+        settings.load_function_name,
+        settings.template_function_name,
+        settings.write_variable_name,
+        settings.encode_function_name,
+
+        settings.compile_flags,
+        settings.optimize_level,
+
+        settings.inline_includes,
+        settings.function_mode,
+        settings.partial_evaluation,
+        settings.bytes_mode,
+        settings.chunk_size,
+        settings.bulk_mode,
+
+        tuple(sorted((name, repr(value)) for name, value in constants)),
+    )
+
+# --- compiler environment & functions ---
+
+# CompilerEnvironment holds settings, and state of the running compile:
+# macro_stack, indent, dependencies, include_stack, static_text and
+# passthrough.
+
+class CompilerEnvironment:
+    def __init__(
+            self,
+
+            code_generators = None,
+
+            # --- suffixes & prefixes ---
+            macro_prefix = '@',
+            macro_suffix = '',
+
+            statement_prefix = '#',
+            statement_suffix = '',
+
+            comment_prefix = '%',
+            comment_suffix = '',
 
             variable_prefix = '${',
             variable_suffix = '}',
@@ -1500,9 +2425,27 @@ class CompilerEnvironment:
             include_function_name = _DEFAULT_INCLUDE_FUNCTION_NAME,
             place_function_name = _DEFAULT_PLACE_FUNCTION_NAME,
 
+            load_function_name = _DEFAULT_LOAD_FUNCTION_NAME,
+
+            template_function_name = _DEFAULT_TEMPLATE_FUNCTION_NAME,
+            write_variable_name = _DEFAULT_WRITE_VARIABLE_NAME,
+
+            encode_function_name = _DEFAULT_ENCODE_FUNCTION_NAME,
+
             # --- flags ---
             compile_flags = _COMPILE_FLAGS,
             optimize_level = _OPTIMIZE_LEVEL,
+
+            # --- options ---
+            inline_includes = False,
+            function_mode = False,
+            partial_evaluation = False,
+            bytes_mode = False,
+            chunk_size = None,
+            bulk_mode = False,
+
+            # --- constants ---
+            constants = None,
             ):
 
         # *** code generators & macro_stack ***
@@ -1510,8 +2453,6 @@ class CompilerEnvironment:
         self.code_generators = \
             code_generators or _default_code_generators.copy()
 
-        self.macro_stack = collections.deque()
-
 
         # *** suffixes & prefixes ***
 
@@ -1562,38 +2503,11 @@ class CompilerEnvironment:
             self.evaluation_suffix = evaluation_suffix
 
 
-        # --- macro re ---
-
-        self.macro_re = re.compile(
-            _MACRO_PATTERN.format(
-                macros = '|'.join(macro for macro in self.code_generators),
-            )
-        )
-
-
-        # --- evaluation & variable ---
-
-        if (not variable_prefix) or (not variable_suffix):
-            raise ValueError(
-                    "variable_prefix & variable_suffix can't be empty")
-
-        if (not evaluation_prefix) or (not evaluation_suffix):
-            raise ValueError(
-                    "evaluation_prefix & evaluation_suffix can't be empty")
-
-
-        self.evaluation_variable_re = re.compile(
-            _EVALUATION_PATTERN.format(
-                prefix = re.escape(evaluation_prefix),
-                suffix = re.escape(evaluation_suffix),
-            ) + '|' +
+        # --- matchers ---
 
-            _VARIABLE_PATTERN.format(
-                prefix = re.escape(variable_prefix),
-                pattern = _VARIABLE_NAME_PATTERN,
-                suffix = re.escape(variable_suffix),
-            )
-        )
+        # regexes are looked up by current macros, prefixes & suffixes, so
+        # they follow changes of settings & languages.
+        self.matchers()
 
 
         # *** variable names ***
@@ -1609,6 +2523,13 @@ class CompilerEnvironment:
         self.include_function_name = include_function_name
         self.place_function_name = place_function_name
 
+        self.load_function_name = load_function_name
+
+        self.template_function_name = template_function_name
+        self.write_variable_name = write_variable_name
+
+        self.encode_function_name = encode_function_name
+
 
         # *** indent & tabs ***
 
@@ -1622,13 +2543,247 @@ class CompilerEnvironment:
         self.optimize_level = optimize_level
 
 
+        # *** options ***
+
+        self.inline_includes = inline_includes
+
+        # in function mode template body is wrapped in a function, so its
+        # variables are locals.
+        self.function_mode = function_mode
+
+        # statements that only depend on literals are evaluated at compile
+        # time and replaced by their output.
+        self.partial_evaluation = partial_evaluation
+
+        # in bytes mode templates are read as latin-1, so text is copied to
+        # bytes constants unchanged, while code is transcoded to utf-8.
+        # substitutions are encoded to utf-8 and output is binary.
+        self.bytes_mode = bytes_mode
+
+        # generated code of large templates is compiled in chunks of about
+        # chunk_size characters, split between top-level lines. None compiles
+        # the whole template at once.
+        self.chunk_size = chunk_size
+
+        # in bulk mode the whole template is read at once, only lines that
+        # may be macros, statements or comments are found by a regex, and
+        # text between them is written by a single call.
+        self.bulk_mode = bulk_mode
+
+
+        # *** constants ***
+
+        # '${NAME}' substitutions of these names are replaced by str(value)
+        # at compile time.
+        self.constants = constants if constants is not None else {}
+
+
+        # *** compile state ***
+
+        self.reset()
+
+
     # *** CompilerEnvironment methods ***
 
+    # resets state of the running compile
+
+    def reset(self):
+
+        self.macro_stack = collections.deque()
+
+
+        # *** inlined files ***
+
+        # dependencies contains (file_name, real_path, mtime_ns) of inlined
+        # files, compiled code is valid as long as they don't change.
+        self.dependencies = []
+        self.include_stack = []
+
+
+        # *** static text ***
+
+        # static_text is a list of output lines, as long as the template has
+        # no macros, statements or substitutions; otherwise None.
+        # passthrough is True if output is also equal to the template.
+        self.static_text = None
+        self.passthrough = False
+
+    # returns a frozen snapshot of settings
+
+    def config(self):
+        settings = dict(
+            (name, getattr(self, name)) for name in _COMPILER_CONFIG_FIELDS)
+
+        settings['code_generators'] = tuple(self.code_generators.items())
+        settings['constants'] = tuple(sorted(self.constants.items()))
+
+        return CompilerConfig(**settings)
+
+    # returns a new environment with settings of config
+
+    @classmethod
+    def from_config(cls, config):
+        env = object.__new__(cls)
+        env.__dict__.update(config._asdict())
+
+        env.code_generators = dict(config.code_generators)
+        env.constants = dict(config.constants)
+
+        env.reset()
+
+        return env
+
     def tabs(self):
         return self.tab * self.indent
 
+    # returns the shared regexes of current macros, prefixes & suffixes
+
+    def matchers(self):
+        return _get_matchers((
+            tuple(self.code_generators),
+            self.macro_prefix,
+            self.statement_prefix,
+            self.comment_prefix,
+            self.variable_prefix,
+            self.variable_suffix,
+            self.evaluation_prefix,
+            self.evaluation_suffix,
+        ))
+
+    @property
+    def macro_re(self):
+        return self.matchers().macro_re
+
+    @property
+    def evaluation_variable_re(self):
+        return self.matchers().evaluation_variable_re
+
+    @property
+    def directive_re(self):
+        return self.matchers().directive_re
+
+    # returns a copy that shares settings, regexes & code generators, with
+    # its own per-file state.
+
+    def clone(self):
+        env = object.__new__(type(self))
+        env.__dict__.update(self.__dict__)
+
+        env.reset()
+
+        return env
+
+    # code objects compiled with environments that have equal cache keys
+    # are interchangeable. None if code isn't cached (custom code
+    # generators).
+
+    def cache_key(self):
+        return _cache_key(
+                self,
+                self.code_generators.items(),
+                self.constants.items(),
+                )
+
+    # returns the expression that generated code calls to write text
+
+    def write_function(self):
+        if self.function_mode:
+            return self.write_variable_name
+
+        return self.outfile_variable_name + '.write'
+
+    # opens a template file in the mode that generate_code expects
+
+    def open_template(self, file_name):
+        if self.bytes_mode:
+            return open(file_name, 'rt', encoding = 'latin-1', newline = '')
+
+        return open(file_name, 'rt')
+
+# a failed generation restores indent and stacks of env, so it can be used
+# again.
+
 def generate_code(infile, outfile, env):
 
+    indent = env.indent
+
+    try:
+        _generate_code(infile, outfile, env)
+
+    except BaseException:
+        env.indent = indent
+        env.macro_stack.clear()
+        env.include_stack.clear()
+        raise
+
+# in function mode, the template is the body of a function:
+#
+#   def __template__():
+#       __write__ = __outfile__.write
+#       ...
+#       return locals()
+#   globals().update(__template__())
+#
+# its variables are fast locals while it runs, and are published to the
+# namespace when it returns, so later inputs & templates that share the
+# namespace see them as without function mode. functions of '@def' write by
+# the '__write__' of their template. lines of the body are moved up by
+# _FUNCTION_HEADER_LINES when it's compiled, the call is on the first line.
+
+def _generate_code(infile, outfile, env):
+
+    if env.function_mode:
+
+        # --- function header ---
+        outfile.write(
+            '{}def {}():\n'.format(
+                env.tabs(),
+                env.template_function_name,
+            )
+        )
+        env.indent += 1
+
+        outfile.write(
+            '{}{} = {}.write\n'.format(
+                env.tabs(),
+                env.write_variable_name,
+                env.outfile_variable_name,
+            )
+        )
+
+        _generate_lines(infile, outfile, env)
+
+        if env.macro_stack:
+            raise CompilerError(_UNTERMINATED_BLOCK, env.macro_stack[-1])
+
+        # --- publish variables ---
+        outfile.write('{}return locals()\n'.format(env.tabs()))
+
+        # --- call function ---
+        env.indent -= 1
+        outfile.write(
+            '{}globals().update({}())\n'.format(
+                env.tabs(),
+                env.template_function_name,
+            )
+        )
+
+    else:
+
+        _generate_lines(infile, outfile, env)
+
+        if env.macro_stack:
+            raise CompilerError(_UNTERMINATED_BLOCK, env.macro_stack[-1])
+
+def _generate_lines(infile, outfile, env):
+
+    if env.bulk_mode:
+        return _generate_bulk(infile, outfile, env)
+
+    return _generate_line_by_line(infile, outfile, env)
+
+def _generate_line_by_line(infile, outfile, env):
+
     code_generators = env.code_generators
 
     # --- macro ---
@@ -1648,8 +2803,17 @@ def generate_code(infile, outfile, env):
     # --- evaluation variable ---
     evaluation_variable_re = env.evaluation_variable_re
 
-    # --- outfile variable name ---
-    outfile_variable_name = env.outfile_variable_name
+    # --- write function ---
+    write_function = env.write_function()
+
+    # --- constants ---
+    constants = env.constants
+
+    # --- encode function ---
+    encode_function = env.encode_function_name if env.bytes_mode else None
+
+    # --- static text ---
+    static_text = env.static_text
 
     for line in infile:
 
@@ -1667,7 +2831,14 @@ def generate_code(infile, outfile, env):
             if m:
 
                 generate_code = code_generators[m.group('macro')]
+
+                # include macro may be inlined, it handles static text itself
+                if generate_code is not _generate_include:
+                    static_text = None
+
+                env.static_text = static_text
                 generate_code(m.group('args'), outfile, env)
+                static_text = env.static_text
 
                 continue
 
@@ -1684,6 +2855,8 @@ def generate_code(infile, outfile, env):
                     )
                 )
 
+            static_text = None
+
             continue
 
         # --- check comment ---
@@ -1691,154 +2864,1785 @@ def generate_code(infile, outfile, env):
                 striped_line.endswith(comment_suffix):
             outfile.write('\n')
 
+            env.passthrough = False
+
             continue
 
         # --- check for evaluations & variables ---
-        outfile.write(env.tabs())
+        text = _generate_text(line, outfile, env.tabs(), write_function,
+                evaluation_variable_re, constants, encode_function)
 
-        m = evaluation_variable_re.search(line)
-        while m:
+        if static_text is not None:
+            if text is None:
+                static_text = None
 
-            # --- write primitive remains ---
-            if m.start() != 0:
-                outfile.write(
-                    '{}.write({});'.format(
-                        outfile_variable_name,
-                        repr(line[:m.start()]),
-                    )
-                )
+            else:
+                static_text.append(text)
 
-            name = m.group('name')
+                if text != line:
+                    env.passthrough = False
 
-            if name is None:
-                # --- write evaluation ---
-                outfile.write(
-                    '{}.write(str({}));'.format(
-                        outfile_variable_name,
-                        m.group('eval'),
-                    )
-                )
+    env.static_text = static_text
 
-            else:
-                # --- write variable ---
-                outfile.write(
-                    '{}.write(str({}));'.format(
-                        outfile_variable_name,
-                        name,
-                    )
-                )
+# --- bulk mode ---
 
-            # --- check remaining line ---
-            if m.end() == len(line):
-                outfile.write('\n')
-                break
+# lines that start with a macro, statement or comment prefix are generated
+# line by line, and so are lines of text that have evaluations or variables.
+# everything between them is a span of text that is written by a single call.
+# the generated code is padded with empty lines, so its line numbers are same
+# as line by line generation.
 
-            line = line[m.end():]
-            m = evaluation_variable_re.search(line)
+def _generate_bulk(infile, outfile, env):
 
-        else:
+    text = infile.read()
 
-            # --- writing text ---
-            outfile.write(
-                '{}.write({});\n'.format(
-                    outfile_variable_name,
-                    repr(line),
-                )
-            )
+    directive_re = env.directive_re
 
-    if env.macro_stack:
-        raise CompilerError(_UNTERMINATED_BLOCK, env.macro_stack[-1])
+    position = 0
 
-def compile_generated_code(
-        code,
-        infile_name,
-        flags = _COMPILE_FLAGS,
-        optimize = _OPTIMIZE_LEVEL,
-        ):
+    for m in directive_re.finditer(text):
 
-    return compile(code, infile_name, 'exec', flags, True, optimize)
+        if position < m.start():
+            _generate_span(text[position:m.start()], outfile, env)
 
-def compile_file(infile, env):
+        _generate_line_by_line((m.group(),), outfile, env)
 
-    with io.StringIO() as string_buffer:
+        position = m.end()
 
-        generate_code(infile, string_buffer, env)
+    if position < len(text):
+        _generate_span(text[position:], outfile, env)
 
-        return compile(string_buffer.getvalue(), infile.name, 'exec',
-                env.compile_flags, True, env.optimize_level)
+def _generate_span(span, outfile, env):
 
-_default_builtins = builtins
+    tabs = env.tabs()
+    write_function = env.write_function()
 
-# --- executor environment & functions ---
+    evaluation_variable_re = env.evaluation_variable_re
+    encode_function = env.encode_function_name if env.bytes_mode else None
 
-class ExecutorEnvironment:
-    def __init__(self,
+    position = 0
 
-            variables = None,
-            builtins = None,
+    for m in evaluation_variable_re.finditer(span):
 
-            pipes = None,
+        # previous substitutions of the same line
+        if m.start() < position:
+            continue
 
-            # --- variable names ---
-            outfile_variable_name = _DEFAULT_OUTFILE_VARIABLE_NAME,
+        start = span.rfind('\n', position, m.start()) + 1 or position
+        end = span.find('\n', m.end()) + 1 or len(span)
 
-            pipes_varaible_name = _DEFAULT_PIPES_VARIABLE_NAME,
-            divert_function_name = _DEFAULT_DIVERT_FUNCTION_NAME,
-            undivert_function_name = _DEFAULT_UNDIVERT_FUNCTION_NAME,
+        if position < start:
+            _generate_plain(span[position:start], outfile, env,
+                    tabs, write_function, encode_function)
 
-            run_function_name = _DEFAULT_RUN_FUNCTION_NAME,
+        text = _generate_text(span[start:end], outfile, tabs, write_function,
+                evaluation_variable_re, env.constants, encode_function)
 
-            include_function_name = _DEFAULT_INCLUDE_FUNCTION_NAME,
-            place_function_name = _DEFAULT_PLACE_FUNCTION_NAME,
+        if env.static_text is not None:
+            if text is None:
+                env.static_text = None
 
-            version_variable_name = _DEFAULT_VERSION_VARIABLE_NAME,
-            command_variable_name = _DEFAULT_COMMAND_VARIABLE_NAME,
-            argv_variable_name = _DEFAULT_ARGV_VARIABLE_NAME,
-            ):
+            else:
+                env.static_text.append(text)
+                env.passthrough = False
 
-        # --- variables ---
-        if variables is None:
-            variables = {}
+        position = end
 
-        if '__builtins__' not in variables:
-            if builtins is None:
-                builtins = _default_builtins
+    if position < len(span):
+        _generate_plain(span[position:], outfile, env,
+                tabs, write_function, encode_function)
 
-            variables['__builtins__'] = builtins
+# writes lines of text without evaluations & variables
 
-        self.variables = variables
+def _generate_plain(text, outfile, env, tabs, write_function, encode_function):
 
-        # --- pipes ---
-        self.pipes = pipes or collections.defaultdict(io.StringIO)
+    if env.static_text is not None:
+        env.static_text.append(text)
 
-        # --- argv ---
+    # a chunk can't be split inside of a write
+    chunk_size = env.chunk_size or len(text)
 
-        # --- variable names ---
-        self.outfile_variable_name = outfile_variable_name
+    position = 0
+    while position < len(text):
 
-        self.pipes_varaible_name = pipes_varaible_name
-        self.divert_function_name = divert_function_name
-        self.undivert_function_name = undivert_function_name
+        end = text.find('\n', position + chunk_size - 1) + 1 or len(text)
+        part = text[position:end]
 
-        self.run_function_name = run_function_name
+        if encode_function is None:
+            literal = repr(part)
 
-        self.include_function_name = include_function_name
-        self.place_function_name = place_function_name
+        else:
+            literal = repr(part.encode('latin-1'))
 
-        self.version_variable_name = version_variable_name
-        self.command_variable_name = command_variable_name
-        self.argv_variable_name = argv_variable_name
+        outfile.write('{}{}({});\n'.format(tabs, write_function, literal))
 
-def execute_code_object(
-        code_object,
-        outfile,
-        env,
+        lines = part.count('\n')
+        if lines > 1:
+            outfile.write('\n' * (lines - 1))
 
-        working_directory = '.',
+        position = end
 
-        argv = None,
+# text, including its evaluations & variables, is written by a single call:
+#
+#   write('text')
+#   write('text %s text %s' % (variable, (evaluation),))
+#
+# '%s' formats values by str(), same as writing each part separately.
+# variables in constants are folded into the text.
+
+# in bytes mode (encode_function is not None) text is written as bytes, and
+# values are encoded by encode_function:
+#
+#   write(b'text %s text' % (encode(variable),))
+
+# returns the text if it has no evaluations & variables after folding.
+
+def _generate_text(
+        text,
+        outfile,
+        tabs,
+        write_function,
+        evaluation_variable_re,
+        constants,
+        encode_function = None,
+        ):
+
+    # text is latin-1 decoded bytes in bytes mode
+    if encode_function is None:
+        literal = repr
+
+    else:
+        literal = lambda text: repr(text.encode('latin-1'))
+
+    m = evaluation_variable_re.search(text)
+
+    if not m:
+
+        # --- writing text ---
+        outfile.write(
+            '{}{}({});\n'.format(
+                tabs,
+                write_function,
+                literal(text),
+            )
+        )
+
+        return text
+
+    formats = []
+    values = []
+
+    position = 0
+    while m:
+
+        # --- primitive remains ---
+        formats.append(text[position:m.start()].replace('%', '%%'))
+
+        name = m.group('name')
+
+        if name is None:
+            # --- evaluation ---
+            formats.append('%s')
+            values.append('({})'.format(m.group('eval')))
+
+        elif name in constants:
+            # --- constant ---
+            value = str(constants[name])
+
+            if encode_function is not None:
+                value = value.encode('utf-8').decode('latin-1')
+
+            formats.append(value.replace('%', '%%'))
+
+        else:
+            # --- variable ---
+            formats.append('%s')
+            values.append(name)
+
+        position = m.end()
+        m = evaluation_variable_re.search(text, position)
+
+    formats.append(text[position:].replace('%', '%%'))
+
+    if encode_function is not None:
+        values = [
+            '{}({})'.format(encode_function, value) for value in values
+        ]
+
+    if not values:
+
+        # --- writing folded text ---
+        text = ''.join(formats).replace('%%', '%')
+
+        outfile.write(
+            '{}{}({});\n'.format(
+                tabs,
+                write_function,
+                literal(text),
+            )
+        )
+
+        return text
+
+    outfile.write(
+        '{}{}({} % ({},));\n'.format(
+            tabs,
+            write_function,
+            literal(''.join(formats)),
+            ', '.join(values),
+        )
+    )
+
+# --- inline include ---
+
+# literal file names are resolved relative to current working directory, same
+# as '__include__' with its default working_directory.
+
+def _inline_include(file_name, outfile, env):
+    real_path = __realpath(file_name)
+
+    if real_path in env.include_stack:
+        raise CompilerError(
+                _INCLUDE_CYCLE,
+                env.include_stack[env.include_stack.index(real_path):] +
+                    [real_path],
+                )
+
+    env.passthrough = False
+
+    with env.open_template(real_path) as infile:
+
+        env.dependencies.append(
+                (file_name, real_path, os.fstat(infile.fileno()).st_mtime_ns))
+
+        macro_stack_len = len(env.macro_stack)
+
+        env.include_stack.append(real_path)
+        try:
+            _generate_lines(infile, outfile, env)
+
+        finally:
+            env.include_stack.pop()
+
+        if len(env.macro_stack) != macro_stack_len:
+            raise CompilerError(_UNTERMINATED_BLOCK, env.macro_stack[-1])
+
+def _check_dependencies(dependencies):
+    for file_name, real_path, mtime_ns in dependencies:
+        try:
+            if __realpath(file_name) != real_path or \
+                    os.stat(real_path).st_mtime_ns != mtime_ns:
+                return False
+
+        except FileNotFoundError:
+            return False
+
+    return True
+
+def compile_generated_code(
+        code,
+        infile_name,
+        flags = _COMPILE_FLAGS,
+        optimize = _OPTIMIZE_LEVEL,
+        ):
+
+    return compile(code, infile_name, 'exec', flags, True, optimize)
+
+# returns a code object, or a tuple of code objects if env.chunk_size is set
+# and the template is split into chunks.
+
+def compile_file(infile, env):
+
+    env.dependencies = []
+
+    track_static_text = env.static_text is not None
+
+    if env.chunk_size is None:
+
+        with io.StringIO() as string_buffer:
+
+            generate_code(infile, string_buffer, env)
+
+            code = string_buffer.getvalue()
+
+        code_object, text = _compile_code(code, infile.name, env)
+        texts = [text]
+
+    else:
+
+        chunks = _CodeChunks(infile.name, env)
+
+        generate_code(infile, chunks, env)
+
+        code_objects, texts = chunks.close()
+
+        if len(code_objects) == 1:
+            code_object = code_objects[0]
+
+        else:
+            code_object = tuple(code_objects)
+
+    # partial evaluation replaced every statement by its output
+    if track_static_text and None not in texts:
+        if env.bytes_mode:
+            texts = [text.decode('latin-1') for text in texts]
+
+        env.static_text = texts
+        env.passthrough = False
+
+    return code_object
+
+# compiles generated code, returns (code_object, text). text is the whole
+# output if partial evaluation replaced every statement by its output,
+# otherwise None.
+
+def _compile_code(code, infile_name, env):
+
+    # text is in bytes literals, code parts are decoded by latin-1
+    if env.bytes_mode:
+        code = code.encode('latin-1').decode('utf-8')
+
+    text = None
+
+    try:
+        if env.partial_evaluation:
+            code, text = _partial_evaluate(code, infile_name, env)
+
+        elif env.function_mode:
+            code = compile(code, infile_name, 'exec',
+                    env.compile_flags | ast.PyCF_ONLY_AST, True)
+
+    except SyntaxError as e:
+        if env.function_mode:
+            _shift_syntax_error(e, -_FUNCTION_HEADER_LINES)
+        raise
+
+    if env.function_mode:
+        _shift_function_lines(code)
+
+    code_object = compile(code, infile_name, 'exec',
+            env.compile_flags, True, env.optimize_level)
+
+    return code_object, text
+
+# lines of the function header before the template body in function mode
+
+_FUNCTION_HEADER_LINES = 2
+
+# moves lines of a function mode tree up to the lines of the template, the
+# header and the call are on the first line.
+
+def _shift_function_lines(tree):
+    function = tree.body[0]
+
+    for node in function.body[1:]:
+        ast.increment_lineno(node, -_FUNCTION_HEADER_LINES)
+
+    for node in function.body[:1] + tree.body[1:]:
+        ast.increment_lineno(node, 1 - node.lineno)
+
+# moves a SyntaxError of generated code by offset lines, its text is read
+# again from the template at the new line.
+
+def _shift_syntax_error(e, offset):
+    if e.lineno is None or e.lineno + offset < 1:
+        return
+
+    e.lineno += offset
+    e.text = linecache.getline(e.filename, e.lineno) or e.text
+
+    if getattr(e, 'end_lineno', None) is not None:
+        e.end_lineno += offset
+
+# --- code chunks ---
+
+# _CodeChunks is written by generate_code instead of a single buffer. once
+# the buffer holds env.chunk_size characters, it's compiled and cleared
+# before the next top-level line, so no block is split between chunks. memory
+# of generated code, its syntax tree and the compiler is bounded by the chunk
+# size instead of the template.
+#
+# NOTE: code objects of all chunks are kept, so memory still grows with the
+#       template by the size of its code objects (mostly its static text).
+#       cache files store chunks one by one, so they are never marshaled as
+#       a whole.
+#
+# a chunk that ends inside a statement (e.g. an open bracket of a statement
+# line) is kept until the statement ends, its limit doubles on each try. the
+# buffer only outgrows the chunk size by such a statement, and an
+# unterminated one is compiled with the rest of the template and raises its
+# SyntaxError at the end.
+#
+# chunks are executed in order in the same namespace. line numbers of each
+# chunk are shifted to the line numbers of the template.
+#
+# NOTE: function mode templates are a single block, so they aren't split.
+
+class _CodeChunks:
+
+    def __init__(self, infile_name, env):
+        self.infile_name = infile_name
+        self.env = env
+
+        # indent of top-level lines
+        self.indent = env.indent
+
+        self.buffer = io.StringIO()
+        self.size = 0
+        self.limit = env.chunk_size
+
+        # (lineno, msg) of the SyntaxError of an incomplete statement
+        self.incomplete_error = None
+
+        # number of lines in previous chunks
+        self.line_number = 0
+
+        self.code_objects = []
+        self.texts = []
+
+    def write(self, code):
+        env = self.env
+
+        if self.size >= self.limit and \
+                env.indent == self.indent and not env.macro_stack:
+            self.flush()
+
+        self.buffer.write(code)
+        self.size += len(code)
+
+    def flush(self, final = False):
+        code = self.buffer.getvalue()
+
+        try:
+            code_object, text = _compile_code(
+                    code, self.infile_name, self.env)
+
+        except SyntaxError as e:
+
+            # a statement that continues on the next lines is compiled
+            # again with them. the limit doubles, so an unterminated
+            # statement doesn't recompile the buffer after every chunk.
+            # code is tokenized once per error, a later error at the same
+            # place is the same statement that is still incomplete.
+            error = (e.lineno, e.msg)
+
+            if not final and (error == self.incomplete_error or
+                    _is_incomplete_code(code)):
+                self.incomplete_error = error
+                self.limit = self.size * 2
+                return
+
+            # line numbers of the template, compile() read text of the
+            # error from the template at the line number of the chunk.
+            _shift_syntax_error(e, self.line_number)
+            raise
+
+        if self.line_number:
+            code_object = _shift_code_lines(code_object, self.line_number)
+
+        self.code_objects.append(code_object)
+        self.texts.append(text)
+
+        self.line_number += code.count('\n')
+
+        self.buffer = io.StringIO()
+        self.size = 0
+        self.limit = self.env.chunk_size
+        self.incomplete_error = None
+
+    # returns (code_objects, texts)
+    def close(self):
+        if self.size or not self.code_objects:
+            self.flush(final = True)
+
+        return self.code_objects, self.texts
+
+# returns True if code ends inside brackets, a multi-line string or after a
+# line continuation, so its last statement isn't complete yet.
+
+def _is_incomplete_code(code):
+    try:
+        for _ in tokenize.generate_tokens(io.StringIO(code).readline):
+            pass
+
+    except tokenize.TokenError:
+        return True
+
+    except SyntaxError:
+        pass
+
+    return False
+
+def _shift_code_lines(code_object, offset):
+    return code_object.replace(
+            co_firstlineno = code_object.co_firstlineno + offset,
+            co_consts = tuple(
+                _shift_code_lines(const, offset)
+                if isinstance(const, types.CodeType) else const
+                for const in code_object.co_consts
+            ),
+        )
+
+# executes a code object, or chunks of a code object, in namespace
+
+def _exec_code_object(code_object, namespace):
+    if isinstance(code_object, tuple):
+        for chunk in code_object:
+            exec(chunk, namespace)
+
+    else:
+        exec(code_object, namespace)
+
+# --- partial evaluation ---
+
+# a statement of generated code is evaluated at compile time if it is made of
+# the nodes below, calls only builtins of _partial_evaluation_builtins or
+# methods, and doesn't read any variable that is not assigned by previously
+# evaluated statements. it's replaced by a write of its output, and constant
+# assignments of names that it binds.
+#
+# NOTE: builtins are assumed not to be shadowed by defined variables.
+
+_partial_evaluation_builtins = frozenset([
+    'abs', 'all', 'any', 'ascii', 'bin', 'bool', 'chr', 'dict', 'divmod',
+    'enumerate', 'float', 'format', 'frozenset', 'hex', 'int', 'len', 'list',
+    'max', 'min', 'oct', 'ord', 'pow', 'range', 'repr', 'reversed', 'round',
+    'set', 'sorted', 'str', 'sum', 'tuple', 'zip',
+])
+
+_partial_evaluation_nodes = (
+    # statements
+    ast.Expr, ast.Assign, ast.AugAssign, ast.For, ast.While, ast.If,
+    ast.Pass, ast.Break, ast.Continue,
+
+    # expressions
+    ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.IfExp, ast.Compare, ast.Call,
+    ast.Constant, ast.Attribute, ast.Subscript, ast.Slice, ast.Starred,
+    ast.Name, ast.List, ast.Tuple, ast.Dict, ast.Set,
+    ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp,
+    ast.comprehension, ast.JoinedStr, ast.FormattedValue, ast.keyword,
+
+    # contexts & operators
+    ast.expr_context, ast.boolop, ast.operator, ast.unaryop, ast.cmpop,
+)
+
+# pycro functions that never change variables
+_partial_evaluation_safe_functions = (
+    'divert_function_name',
+    'undivert_function_name',
+    'place_function_name',
+    'run_function_name',
+    'encode_function_name',
+)
+
+_constant_types = (
+    type(None), bool, int, float, complex, str, bytes, type(Ellipsis),
+)
+
+def _is_constant_value(value):
+    if type(value) in _constant_types:
+        return True
+
+    if type(value) in (tuple, frozenset):
+        return all(_is_constant_value(item) for item in value)
+
+    return False
+
+def _is_pure_statement(statement, env):
+    for node in ast.walk(statement):
+        if not isinstance(node, _partial_evaluation_nodes):
+            return False
+
+        if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+            return False
+
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name):
+                if node.func.id not in _partial_evaluation_builtins and \
+                        node.func.id != env.write_variable_name and \
+                        node.func.id != env.encode_function_name:
+                    return False
+
+            elif not isinstance(node.func, ast.Attribute):
+                return False
+
+    return True
+
+def _root_name(node):
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+
+    if isinstance(node, ast.Name):
+        return node.id
+
+    return None
+
+# names that statement may bind or mutate: assignment targets, and objects
+# whose items, attributes or methods are changed or called.
+
+def _bound_names(statement):
+    names = set()
+
+    for node in ast.walk(statement):
+        if isinstance(node, ast.Name):
+            if not isinstance(node.ctx, ast.Load):
+                names.add(node.id)
+
+        elif isinstance(node, (ast.Attribute, ast.Subscript)):
+            if not isinstance(node.ctx, ast.Load):
+                names.add(_root_name(node))
+
+        elif isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Attribute):
+                names.add(_root_name(node.func))
+
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                ast.ClassDef)):
+            names.add(node.name)
+
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add((alias.asname or alias.name).split('.')[0])
+
+    names.discard(None)
+    return names
+
+# true if statement may change variables that are not in its bound names
+
+def _has_hidden_effects(statement, env):
+    safe_functions = _partial_evaluation_builtins.union(
+            getattr(env, name) for name in _partial_evaluation_safe_functions)
+    safe_functions = safe_functions.union([env.write_variable_name])
+
+    for node in ast.walk(statement):
+        if isinstance(node, (ast.Global, ast.Nonlocal, ast.ImportFrom)):
+            return True
+
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name):
+                if node.func.id not in safe_functions:
+                    return True
+
+            elif not isinstance(node.func, ast.Attribute):
+                return True
+
+    return False
+
+# forgets names of sandbox that a statement bound or mutated. mutable values
+# may be reached by other names (aliases, items of containers), so all of them
+# are forgotten too, except sandbox_names.
+
+def __forget_names(sandbox, names, sandbox_names):
+    if not names:
+        return
+
+    for name in list(sandbox):
+        if name in names or (name not in sandbox_names and
+                not _is_constant_value(sandbox[name])):
+            sandbox.pop(name)
+
+def _is_write_statement(statement, write_dump):
+    return isinstance(statement, ast.Expr) and \
+            isinstance(statement.value, ast.Call) and \
+            ast.dump(statement.value.func) == write_dump and \
+            len(statement.value.args) == 1 and \
+            not statement.value.keywords and \
+            isinstance(statement.value.args[0], ast.Constant) and \
+            isinstance(statement.value.args[0].value, (str, bytes))
+
+# returns (tree, text), text is the whole output if every statement is
+# replaced by its output, otherwise None.
+
+def _partial_evaluate(code, filename, env):
+    tree = ast.parse(code, filename)
+
+    write_node = ast.parse(env.write_function(), mode = 'eval').body
+    write_dump = ast.dump(write_node)
+
+    if env.function_mode:
+        # def __template__():
+        #     __write__ = __outfile__.write
+        #     ...
+        #     return locals()
+        # globals().update(__template__())
+        body = tree.body[0].body
+        header = body[:1]
+        statements = body[1:-1]
+        footer = body[-1:]
+
+    else:
+        header = []
+        statements = tree.body
+        footer = []
+
+    # --- sandbox namespace ---
+
+    output = io.BytesIO() if env.bytes_mode else io.StringIO()
+
+    sandbox_names = {
+        '__builtins__': {
+            name: getattr(builtins, name)
+            for name in _partial_evaluation_builtins
+        },
+        env.outfile_variable_name: output,
+        env.write_variable_name: output.write,
+        env.encode_function_name: _encode_value,
+    }
+
+    sandbox = dict(sandbox_names)
+
+    # --- evaluate statements ---
+
+    result = []
+
+    for statement in statements:
+
+        names = _bound_names(statement)
+        bound_names = names.difference(sandbox_names)
+
+        # in function mode '__write__' is bound again after a divert or an
+        # include, it writes nothing but must be kept.
+        if _is_write_statement(statement, write_dump) or \
+                env.write_variable_name in names or \
+                not _is_pure_statement(statement, env):
+
+            result.append(statement)
+
+            # --- forget changed variables ---
+
+            if _has_hidden_effects(statement, env):
+                sandbox.clear()
+                sandbox.update(sandbox_names)
+
+            else:
+                __forget_names(sandbox, bound_names, sandbox_names)
+
+            continue
+
+        bound_before = set(name for name in bound_names if name in sandbox)
+
+        output.seek(0)
+        output.truncate()
+
+        try:
+            exec(
+                compile(
+                    ast.Module(body = [statement], type_ignores = []),
+                    filename,
+                    'exec',
+                    env.compile_flags,
+                    True,
+                ),
+                sandbox,
+            )
+
+        except Exception:
+
+            # it will fail on run time, or depends on unknown variables
+            __forget_names(sandbox, bound_names, sandbox_names)
+
+            result.append(statement)
+            continue
+
+        text = output.getvalue()
+
+        # --- remove statement without output & bound names ---
+
+        if not text and not bound_names:
+            continue
+
+        # --- replace statement by its output ---
+
+        assignments = []
+
+        for name in sorted(bound_names):
+            if name in sandbox:
+                if not _is_constant_value(sandbox[name]):
+                    assignments = None
+                    break
+
+                assignments.append(
+                    ast.Assign(
+                        targets = [ast.Name(id = name, ctx = ast.Store())],
+                        value = ast.Constant(value = sandbox[name]),
+                    )
+                )
+
+            elif name in bound_before:
+                assignments = None
+                break
+
+        if not text or assignments is None:
+            result.append(statement)
+            continue
+
+        replacement = [
+            ast.Expr(
+                value = ast.Call(
+                    func = write_node,
+                    args = [ast.Constant(value = text)],
+                    keywords = [],
+                )
+            )
+        ] + assignments
+
+        for node in replacement:
+            result.append(ast.copy_location(node, statement))
+
+    # --- join adjacent writes ---
+
+    statements = []
+    for statement in result:
+        if statements and \
+                _is_write_statement(statement, write_dump) and \
+                _is_write_statement(statements[-1], write_dump):
+
+            previous = statements[-1]
+            statements[-1] = ast.copy_location(
+                ast.Expr(
+                    value = ast.Call(
+                        func = write_node,
+                        args = [ast.Constant(
+                            value = previous.value.args[0].value +
+                                statement.value.args[0].value,
+                        )],
+                        keywords = [],
+                    )
+                ),
+                previous,
+            )
+
+        else:
+            statements.append(statement)
+
+    if env.function_mode:
+        tree.body[0].body = header + statements + footer
+
+    else:
+        tree.body = statements
+
+    ast.fix_missing_locations(tree)
+
+    # --- whole output ---
+
+    if all(_is_write_statement(statement, write_dump)
+            for statement in statements):
+        text = (b'' if env.bytes_mode else '').join(
+                statement.value.args[0].value for statement in statements)
+
+    else:
+        text = None
+
+    return tree, text
+
+# same as compile_file, but returns the output text (bytes in bytes mode) of
+# templates that have no macros, statements or substitutions, instead of a
+# code object.
+# env.passthrough is True if the output is equal to infile contents.
+
+def _compile_file(infile, env):
+
+    env.static_text = []
+    env.passthrough = True
+
+    try:
+        code_object = compile_file(infile, env)
+
+        if env.static_text is None:
+            env.passthrough = False
+            return code_object
+
+        if env.bytes_mode:
+            return ''.join(env.static_text).encode('latin-1')
+
+        # universal newlines mode may have changed line endings
+        if getattr(infile, 'newlines', None) not in (None, '\n'):
+            env.passthrough = False
+
+        return ''.join(env.static_text)
+
+    finally:
+        env.static_text = None
+
+# --- static files ---
+
+# writes a file to outfile, copies bytes directly if possible. outfile may be
+# a binary file.
+
+def _write_file(file_name, outfile):
+
+    if isinstance(outfile, (io.RawIOBase, io.BufferedIOBase)):
+        buffer_outfile = outfile
+
+    else:
+        buffer_outfile = getattr(outfile, 'buffer', None)
+
+        # encoding of io.StringIO is None
+        encoding = getattr(outfile, 'encoding', None) or ''
+
+        if encoding.lower() != locale.getpreferredencoding(False).lower():
+            buffer_outfile = None
+
+    if buffer_outfile is not None:
+
+        outfile.flush()
+
+        with open(file_name, 'rb') as infile:
+
+            if hasattr(os, 'sendfile'):
+                try:
+                    buffer_outfile.flush()
+
+                    out_fd = buffer_outfile.fileno()
+                    in_fd = infile.fileno()
+                    size = os.fstat(in_fd).st_size
+
+                    offset = 0
+                    while offset < size:
+                        sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+
+                    if offset == size:
+                        return
+
+                    infile.seek(offset)
+
+                except (OSError, io.UnsupportedOperation, AttributeError):
+                    infile.seek(0)
+
+            shutil.copyfileobj(infile, buffer_outfile)
+
+    else:
+
+        with open(file_name, 'rt') as infile:
+            shutil.copyfileobj(infile, outfile)
+
+# --- output files ---
+
+# opens file_name, or standard output if file_name is None, to write output
+# of templates. generated code makes many small writes, so they are collected
+# in a buffer of buffer_size bytes and written in big blocks. a terminal
+# standard output is returned unchanged, so it stays line buffered.
+
+def open_output(file_name = None, buffer_size = None, binary = False):
+    if buffer_size is None:
+        buffer_size = _DEFAULT_OUTPUT_BUFFER_SIZE
+
+    if buffer_size <= 0:
+        raise ValueError('invalid buffer size: {!r}'.format(buffer_size))
+
+    if file_name is None:
+        stdout = sys.stdout
+
+        try:
+            fd = stdout.fileno()
+
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            fd = None
+
+        if fd is None or stdout.isatty():
+            return stdout.buffer if binary else stdout
+
+        stdout.flush()
+
+        if binary:
+            return open(fd, 'wb', buffering = buffer_size, closefd = False)
+
+        outfile = open(fd, 'wt',
+                buffering = buffer_size,
+                encoding = stdout.encoding,
+                errors = stdout.errors,
+                closefd = False,
+                )
+
+    elif binary:
+        return open(file_name, 'wb', buffering = buffer_size)
+
+    else:
+        outfile = open(file_name, 'wt', buffering = buffer_size)
+
+    return outfile
+
+_default_builtins = builtins
+
+# --- run cache ---
+
+# cached results of '__run__' are keyed by the command, the working directory,
+# the stdin contents and the paths, sizes & modification times of declared
+# input files. a result is stored as: (returncode, stdout, stderr)
+
+def _run_cache_key(command, _input, inputs = ()):
+    _hash = hashlib.sha256()
+
+    _hash.update(repr(command).encode('utf-8'))
+    _hash.update(b'\0')
+    _hash.update(os.getcwd().encode('utf-8'))
+
+    # results of bytes mode are bytes
+    if isinstance(_input, bytes):
+        _hash.update(b'\0b')
+        _hash.update(_input)
+
+    else:
+        _hash.update(b'\0')
+        _hash.update(_input.encode('utf-8'))
+
+    for file_name in inputs:
+        file_stat = os.stat(file_name)
+        _hash.update(b'\0')
+        _hash.update(
+            '{}:{}:{}'.format(
+                __abspath(file_name),
+                file_stat.st_size,
+                file_stat.st_mtime_ns,
+            ).encode('utf-8')
+        )
+
+    return _hash.hexdigest()
+
+def _get_run_cache_file_path(cache_folder_path, key):
+    return __joinpath(cache_folder_path, _RUN_CACHE_FOLDER_NAME, key)
+
+# returns (result_time, result) like run_results of ExecutorEnvironment,
+# result_time is the modification time of the cache file, so the age of the
+# result doesn't restart when it's read. may return None if there is no
+# valid cached result
+
+def _read_run_result(cache_file_path, ttl):
+    try:
+        with open(cache_file_path, 'rb') as cache_file:
+
+            result_time = os.fstat(cache_file.fileno()).st_mtime
+            if ttl is not None and time.time() - result_time > ttl:
+                return None
+
+            if cache_file.read(len(_RUN_CACHE_MAGIC_NUMBER)) != \
+                    _RUN_CACHE_MAGIC_NUMBER:
+                return None
+
+            result = _read_marshal_object(cache_file)
+
+    except (FileNotFoundError, EOFError, ValueError, TypeError):
+        return None
+
+    if not (isinstance(result, tuple) and len(result) == 3):
+        return None
+
+    return result_time, result
+
+def _write_run_result(cache_file_path, result):
+    os.makedirs(__splitpath(cache_file_path)[0], exist_ok = True)
+
+    # write to a temporary file first, so concurrent builds never read a
+    # half written result.
+    temp_file_path = '{}.{}'.format(cache_file_path, os.getpid())
+    with open(temp_file_path, 'wb') as cache_file:
+        cache_file.write(_RUN_CACHE_MAGIC_NUMBER)
+        _write_marshal_object(cache_file, result)
+
+    os.replace(temp_file_path, cache_file_path)
+
+# --- json loader ---
+
+# parsed json files of this process, keyed by real path, size & modification
+# time, so a file loaded by many templates is parsed once.
+
+_json_objects = {}
+
+def _is_json_lines_file(file_name):
+    return file_name.lower().endswith(_JSON_LINES_EXTENSIONS)
+
+def _load_json_file(file_name):
+    real_path = __realpath(file_name)
+    file_stat = os.stat(real_path)
+
+    key = (real_path, file_stat.st_size, file_stat.st_mtime_ns)
+
+    try:
+        return _json_objects[key]
+
+    except KeyError:
+        pass
+
+    if _is_json_lines_file(real_path):
+        json_object = list(_iter_json_file(real_path))
+
+    else:
+        with open(real_path, 'rt') as infile:
+            json_object = json.load(infile)
+
+    _json_objects[key] = json_object
+
+    return json_object
+
+def _iter_json_file(file_name, chunk_size = _JSON_CHUNK_SIZE):
+    with open(file_name, 'rt') as infile:
+
+        if _is_json_lines_file(file_name):
+            for line in infile:
+                if not line.isspace():
+                    yield json.loads(line)
+
+        else:
+            for item in _iter_json_array(infile, chunk_size):
+                yield item
+
+_JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+_ARRAY_START = 0
+_ARRAY_FIRST_VALUE = 1
+_ARRAY_VALUE = 2
+_ARRAY_SEPARATOR = 3
+
+# decodes items of a top level JSON array one by one, only the current item
+# and at most one chunk are kept in memory.
+
+def _iter_json_array(infile, chunk_size = _JSON_CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+
+    _buffer = ''
+    position = 0
+    eof = False
+    need_more = False
+
+    state = _ARRAY_START
+
+    while True:
+
+        # --- read next chunk ---
+        if need_more:
+            chunk = infile.read(max(chunk_size, len(_buffer) - position))
+            if not chunk:
+                eof = True
+
+            _buffer = _buffer[position:] + chunk
+            position = 0
+            need_more = False
+
+        position = _JSON_WHITESPACE_RE.match(_buffer, position).end()
+
+        if position == len(_buffer):
+            if eof:
+                raise ValueError("End of file while reading JSON array")
+
+            need_more = True
+            continue
+
+        if state == _ARRAY_START:
+            if _buffer[position] != '[':
+                raise ValueError("JSON array expected")
+
+            position += 1
+            state = _ARRAY_FIRST_VALUE
+
+        elif state == _ARRAY_SEPARATOR:
+            if _buffer[position] == ']':
+                return
+
+            elif _buffer[position] != ',':
+                raise ValueError(
+                        "',' or ']' expected in JSON array, got: {!r}".format(
+                            _buffer[position]))
+
+            position += 1
+            state = _ARRAY_VALUE
+
+        else: # state in (_ARRAY_FIRST_VALUE, _ARRAY_VALUE)
+            if state == _ARRAY_FIRST_VALUE and _buffer[position] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(_buffer, position)
+
+            except ValueError:
+                if eof:
+                    raise
+
+                need_more = True
+                continue
+
+            # a number at end of buffer may continue in the next chunk
+            if end == len(_buffer) and not eof:
+                need_more = True
+                continue
+
+            yield item
+
+            position = end
+            state = _ARRAY_SEPARATOR
+
+# --- coprocesses ---
+
+# a coprocess is a long-lived helper process started once per command and
+# protocol, '__run__' then sends requests to it instead of spawning a new
+# process for each call.
+
+class _Coprocess:
+    def __init__(self, command, protocol = _LINE_PROTOCOL):
+        if protocol not in (_LINE_PROTOCOL, _LENGTH_PROTOCOL):
+            raise ValueError(
+                    "unknown coprocess protocol: {!r}".format(protocol))
+
+        self.command = command
+        self.protocol = protocol
+
+        self.process = subprocess.Popen(
+                command,
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+                shell = isinstance(command, str),
+        )
+
+    def call(self, _input):
+        if self.process.poll() is not None:
+            raise ChildProcessError(
+                    "coprocess {!r} exited with code {}".format(
+                        self.command,
+                        self.process.returncode,
+                    )
+                )
+
+        stdin = self.process.stdin
+        stdout = self.process.stdout
+
+        # bytes input (bytes mode) returns bytes output
+        binary = isinstance(_input, bytes)
+        if not binary:
+            _input = _input.encode('utf-8')
+
+        if self.protocol == _LINE_PROTOCOL:
+
+            _input = _input.rstrip(b'\n')
+            if b'\n' in _input:
+                raise ValueError(
+                        "input of a line protocol coprocess must be "
+                        "a single line")
+
+            stdin.write(_input + b'\n')
+            stdin.flush()
+
+            _buffer = stdout.readline()
+            if not _buffer:
+                raise EOFError("End of file while reading coprocess output")
+
+        else: # self.protocol == _LENGTH_PROTOCOL
+
+            _write_size(stdin, len(_input))
+            stdin.write(_input)
+            stdin.flush()
+
+            _buffer_size = _read_size(stdout)
+            _buffer = stdout.read(_buffer_size)
+            if len(_buffer) != _buffer_size:
+                raise EOFError("End of file while reading coprocess output")
+
+        return _buffer if binary else _buffer.decode('utf-8')
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(_COPROCESS_CLOSE_TIMEOUT)
+
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+        self.process.stdout.close()
+
+# --- process runner ---
+
+# runs command by shell if it's a str, otherwise without a shell. input &
+# outputs are bytes if binary is True, otherwise str.
+
+def _run_process(command, _input, binary):
+    process = subprocess.run(
+            command,
+            input = _input,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE,
+            shell = isinstance(command, str),
+            universal_newlines = not binary,
+    )
+
+    return (process.returncode, process.stdout, process.stderr)
+
+# --- executor environment & functions ---
+
+class ExecutorEnvironment:
+    def __init__(self,
+
+            variables = None,
+            builtins = None,
+
+            pipes = None,
+
+            # --- variable names ---
+            outfile_variable_name = _DEFAULT_OUTFILE_VARIABLE_NAME,
+
+            pipes_varaible_name = _DEFAULT_PIPES_VARIABLE_NAME,
+            divert_function_name = _DEFAULT_DIVERT_FUNCTION_NAME,
+            undivert_function_name = _DEFAULT_UNDIVERT_FUNCTION_NAME,
+
+            run_function_name = _DEFAULT_RUN_FUNCTION_NAME,
+
+            include_function_name = _DEFAULT_INCLUDE_FUNCTION_NAME,
+            place_function_name = _DEFAULT_PLACE_FUNCTION_NAME,
+
+            load_function_name = _DEFAULT_LOAD_FUNCTION_NAME,
+
+            encode_function_name = _DEFAULT_ENCODE_FUNCTION_NAME,
+
+            version_variable_name = _DEFAULT_VERSION_VARIABLE_NAME,
+            command_variable_name = _DEFAULT_COMMAND_VARIABLE_NAME,
+            argv_variable_name = _DEFAULT_ARGV_VARIABLE_NAME,
+
+            # --- compiler environment for included files ---
+            compiler_env = None,
+
+            # --- bytes mode ---
+            bytes_mode = False,
+
+            # --- run cache ---
+            cache_folder_path = None,
+            run_cache = False,
+            run_cache_ttl = _DEFAULT_RUN_CACHE_TTL,
+
+            # --- process runner ---
+            run_process = None,
+            ):
+
+        # --- variables ---
+        if variables is None:
+            variables = {}
+
+        if '__builtins__' not in variables:
+            if builtins is None:
+                builtins = _default_builtins
+
+            variables['__builtins__'] = builtins
+
+        self.variables = variables
+
+        # --- bytes mode ---
+
+        # code compiled in bytes mode writes bytes, so outfile and pipes are
+        # binary and pycro functions read & write bytes.
+        self.bytes_mode = bytes_mode
+
+        # --- pipes ---
+        self.pipes = pipes or collections.defaultdict(
+                io.BytesIO if bytes_mode else io.StringIO)
+
+        # --- argv ---
+
+        # --- variable names ---
+        self.outfile_variable_name = outfile_variable_name
+
+        self.pipes_varaible_name = pipes_varaible_name
+        self.divert_function_name = divert_function_name
+        self.undivert_function_name = undivert_function_name
+
+        self.run_function_name = run_function_name
+
+        self.include_function_name = include_function_name
+        self.place_function_name = place_function_name
+
+        self.load_function_name = load_function_name
+
+        self.encode_function_name = encode_function_name
+
+        self.version_variable_name = version_variable_name
+        self.command_variable_name = command_variable_name
+        self.argv_variable_name = argv_variable_name
+
+        # --- compiler environment ---
+        self.compiler_env = compiler_env
+
+        # --- run cache ---
+
+        # results are kept in memory for the current process, and also in
+        # cache folder if cache_folder_path is not None.
+        self.cache_folder_path = cache_folder_path
+        self.run_cache = run_cache
+        self.run_cache_ttl = run_cache_ttl
+
+        self.run_results = {}
+
+        # --- coprocesses ---
+        self.coprocesses = {}
+
+        # --- process runner ---
+
+        # '__run__' runs commands by:
+        #   run_process(command, _input, binary) -> (returncode, stdout, stderr)
+        self.run_process = run_process or _run_process
+
+        # --- executor ---
+        self.executor = None
+
+    # *** ExecutorEnvironment methods ***
+
+    def get_coprocess(self, command, protocol = _LINE_PROTOCOL):
+        key = (
+                command if isinstance(command, str) else tuple(command),
+                protocol,
+            )
+
+        try:
+            return self.coprocesses[key]
+
+        except KeyError:
+            coprocess = self.coprocesses[key] = _Coprocess(command, protocol)
+            return coprocess
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = _Executor(self)
+
+        return self.executor
+
+    def close(self):
+        while self.coprocesses:
+            self.coprocesses.popitem()[1].close()
+
+# --- encode function ---
+
+# substitutions of bytes mode are encoded by '__encode__', bytes values are
+# written unchanged.
+
+def _encode_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value
+
+    return str(value).encode('utf-8')
+
+# --- executor ---
+
+# _Executor keeps the state of the running code, its methods are pycro
+# functions (divert, include, run, ...). bound methods are created once per
+# executor and installed into variables, and reset() prepares the executor for
+# the next code object.
+#
+# NOTE: an executor runs one code object at a time, included files are run by
+#       the same executor.
+
+class _Executor:
+    def __init__(self, env):
+        self.env = env
+
+        # --- state ---
+        self.outfile = None
+        self.pipes = None
+
+        # namespaces[-1] is the namespace of the running code, it differs
+        # from variables only inside isolated includes.
+        self.namespaces = []
+
+        # real path of running file is added to include_stack on first
+        # include, so renders without includes don't touch file system.
+        self.file_name = None
+        self.include_stack = []
+
+        self.working_directory = '.'
+
+        # --- pycro functions ---
+        self.functions = {
+            env.divert_function_name: self.divert,
+            env.undivert_function_name: self.undivert,
+            env.place_function_name: self.place,
+            env.include_function_name: self.include,
+            env.run_function_name: self.run,
+            env.load_function_name: self.load,
+            env.encode_function_name: _encode_value,
+        }
+
+        # variables which functions are installed into
+        self.variables = None
+
+    # *** _Executor methods ***
+
+    def reset(self,
+            outfile,
+            pipes,
+            variables,
+            file_name = None,
+            working_directory = '.',
+            ):
+
+        self.outfile = outfile
+        self.pipes = pipes
+        self.namespaces[:] = [variables]
+        self.file_name = file_name
+        self.include_stack.clear()
+        self.working_directory = working_directory
+
+    def install(self, variables):
+        variables.update(self.functions)
+        variables[self.env.version_variable_name] = VERSION
+        self.variables = variables
+
+    # --- divert function ---
+
+    def divert(self, target = None):
+        if not (isinstance(target, (str, int)) or target is None):
+            raise TypeError(
+                    "divert target must be type of str or int or None")
+        self.namespaces[-1][self.env.outfile_variable_name] = \
+                self.pipes[target]
+
+    # --- undivert function ---
+
+    def undivert(self, target):
+        if not isinstance(target, (str, int)):
+            raise TypeError(
+                    "undivert target must be type of str or int")
+        self.outfile.write(self.pipes[target].getvalue())
+
+    # --- place function ---
+
+    def place(self, file_name, output = None):
+        output = self.pipes[output]
+        with open(
+                os.path.join(self.working_directory, file_name),
+                'rb' if self.env.bytes_mode else 'rt',
+                ) as infile:
+            output.write(infile.read())
+
+    # --- include function ---
+
+    # included files are compiled through the same caches as input files,
+    # and resolved relative to working_directory like placed files.
+
+    def include(self, file_name, isolate = False):
+        real_path = os.path.realpath(
+                os.path.join(self.working_directory, file_name))
+
+        namespaces = self.namespaces
+        include_stack = self.include_stack
+
+        if not include_stack:
+            include_stack.append(os.path.realpath(self.file_name))
+
+        if real_path in include_stack:
+            raise ExecutorError(
+                    "include cycle: {}".format(
+                        ' -> '.join(include_stack[include_stack.index(
+                            real_path):] + [real_path])
+                    )
+                )
+
+        compiler_env = self.env.compiler_env
+        if compiler_env is None:
+            compiler_env = self.env.compiler_env = CompilerEnvironment()
+
+        # a failed compile can't leave its state in the shared environment
+        include_code_object = _load_code_file(
+                real_path,
+                self.env.cache_folder_path,
+                compiler_env.clone(),
+                )[1]
+
+        # --- static files ---
+
+        outfile = namespaces[-1][self.env.outfile_variable_name]
+
+        if include_code_object is None:
+            _write_file(real_path, outfile)
+            return
+
+        if isinstance(include_code_object, (str, bytes)):
+            outfile.write(include_code_object)
+            return
+
+        if isolate:
+            namespace = {
+                name: namespaces[-1][name]
+                for name in (
+                    '__builtins__',
+                    self.env.outfile_variable_name,
+                    self.env.pipes_varaible_name,
+                    self.env.divert_function_name,
+                    self.env.undivert_function_name,
+                    self.env.place_function_name,
+                    self.env.include_function_name,
+                    self.env.run_function_name,
+                    self.env.load_function_name,
+                    self.env.encode_function_name,
+                    self.env.version_variable_name,
+                    self.env.argv_variable_name,
+                    self.env.command_variable_name,
+                    )
+                if name in namespaces[-1]
+            }
+
+        else:
+            namespace = namespaces[-1]
+
+        include_stack.append(real_path)
+        namespaces.append(namespace)
+        try:
+            _exec_code_object(include_code_object, namespace)
+
+        finally:
+            namespaces.pop()
+            include_stack.pop()
+
+    # --- run function ---
+
+    def run(self,
+            command,
+            stdin = None,
+            stdout = None,
+            stderr = None,
+            check = True,
+
+            cache = None,
+            inputs = (),
+            ttl = None,
+
+            coprocess = False,
+            protocol = _LINE_PROTOCOL,
+            ):
+
+        # command can be a str which runs by shell, or a sequence of
+        # arguments which runs without spawning a shell.
+        if not isinstance(command, str):
+            command = list(command)
+
+        if stdin is None:
+            _input = b'' if self.env.bytes_mode else ''
+
+        elif isinstance(stdin, (str, int)):
+            _input = self.pipes[stdin].getvalue()
+
+        else:
+            raise TypeError(
+                    "run stdin argument must be type of str or int")
+
+        if stdout is None or isinstance(stdout, (str, int)):
+            stdout = self.pipes[stdout]
+        else:
+            raise TypeError(
+                    "run stdout argument must be None or type of str or int")
+
+        if stderr is None or isinstance(stderr, (str, int)):
+            stderr = self.pipes[stderr]
+        else:
+            raise TypeError(
+                    "run stderr argument must be None or type of str or int")
+
+        if cache is None:
+            cache = self.env.run_cache
+
+        if ttl is None:
+            ttl = self.env.run_cache_ttl
+
+        # --- look up cached result ---
+
+        result = None
+
+        if cache:
+            key = _run_cache_key(command, _input, inputs)
+
+            if key in self.env.run_results:
+                result_time, result = self.env.run_results[key]
+
+                if ttl is not None and time.time() - result_time > ttl:
+                    result = None
+
+            if result is None and self.env.cache_folder_path is not None:
+                cache_file_path = _get_run_cache_file_path(
+                        self.env.cache_folder_path,
+                        key,
+                        )
+
+                cached = _read_run_result(cache_file_path, ttl)
+
+                if cached is not None:
+                    result = cached[1]
+                    self.env.run_results[key] = cached
+
+        # --- run command ---
+
+        if result is None:
+            self.outfile.flush()
+
+            if coprocess:
+                result = (
+                        0,
+                        self.env.get_coprocess(command, protocol).call(_input),
+                        b'' if self.env.bytes_mode else '',
+                    )
+
+            else:
+                result = self.env.run_process(
+                        command,
+                        _input,
+                        self.env.bytes_mode,
+                        )
+
+            # failed commands are never cached
+            if cache and result[0] == 0:
+                self.env.run_results[key] = (time.time(), result)
+
+                if self.env.cache_folder_path is not None:
+                    _write_run_result(cache_file_path, result)
+
+        returncode, result_stdout, result_stderr = result
+
+        stdout.write(result_stdout)
+        stderr.write(result_stderr)
+
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(
+                    returncode,
+                    command,
+                    result_stdout,
+                    result_stderr,
+            )
+
+    # --- load function ---
+    # load json file and update variables, same as '-l, --load JSONFILE'
+    # option.
+
+    # with stream = True an iterator over items of a JSON array or a JSON
+    # Lines file is returned, and variables are not updated.
+
+    def load(self, file_name, name = None, stream = False):
+        file_name = os.path.join(self.working_directory, file_name)
+
+        if stream:
+            json_object = _iter_json_file(file_name)
+
+        else:
+            json_object = _load_json_file(file_name)
+
+        if name is not None:
+            self.namespaces[-1][name] = json_object
+
+        elif not stream:
+            self.namespaces[-1].update(json_object)
+
+        return json_object
+
+def execute_code_object(
+        code_object,
+        outfile,
+        env,
+
+        working_directory = '.',
+
+        argv = None,
         ):
 
+    # --- static text ---
+
+    if isinstance(code_object, (str, bytes)):
+        outfile.write(code_object)
+        return
+
     # --- set up variables & pipes ---
 
     variables = env.variables
@@ -1847,6 +4651,28 @@ def execute_code_object(
 
     pipes[None] = outfile
 
+    executor = env.get_executor()
+
+    if isinstance(code_object, tuple):
+        file_name = code_object[0].co_filename
+
+    else:
+        file_name = code_object.co_filename
+
+    executor.reset(
+            outfile,
+            pipes,
+            variables,
+            file_name,
+            working_directory,
+            )
+
+    # --- pycro functions & version variable ---
+
+    # installed once per variables
+    if executor.variables is not variables:
+        executor.install(variables)
+
     # --- outfile variable ---
 
     variables[env.outfile_variable_name] = outfile
@@ -1855,10 +4681,6 @@ def execute_code_object(
 
     variables[env.pipes_varaible_name] = pipes
 
-    # --- version variable ---
-
-    variables[env.version_variable_name] = VERSION
-
     # --- argv & command variable ---
 
     if argv is not None:
@@ -1867,92 +4689,425 @@ def execute_code_object(
 
         variables[env.command_variable_name] = ' '.join(argv)
 
-    # --- divert function ---
+    # --- executing code_object ---
 
-    def _divert_function(target = None):
-        if not (isinstance(target, (str, int)) or target is None):
-            raise TypeError(
-                    "divert target must be type of str or int or None")
-        variables[env.outfile_variable_name] = pipes[target]
+    return _exec_code_object(code_object, variables)
 
-    variables[env.divert_function_name] = _divert_function
+# --- compiled templates ---
 
-    # --- undivert function ---
+# compiler environment of compiled templates, if compiler_env is None
 
-    def _undivert_function(target):
-        if not isinstance(target, (str, int)):
-            raise TypeError(
-                    "undivert target must be type of str or int")
-        outfile.write(pipes[target].getvalue())
+def _default_compiler_env(compiler_env, executor_env):
+    if compiler_env is not None:
+        return compiler_env
 
-    variables[env.undivert_function_name] = _undivert_function
+    if executor_env is not None and executor_env.compiler_env is not None:
+        return executor_env.compiler_env
 
-    # --- place function ---
+    return CompilerEnvironment()
 
-    def _place_function(file_name, output = None):
-        output = env.pipes[output]
-        with open(__joinpath(working_directory, file_name)) as infile:
-            output.write(infile.read())
+# compile_template() compiles a template once and returns a render function:
+#
+#   render(variables = None, outfile = None)
+#
+# each render executes the template in a new namespace made of executor_env
+# variables, pycro functions and variables. output is written to outfile, or
+# returned as str (bytes in bytes mode) if outfile is None.
+#
+# NOTE: a render function is not reentrant, don't call it from a template
+#       that it renders or from multiple threads at the same time.
+
+def compile_template(
+        template,
+        compiler_env = None,
+        executor_env = None,
+
+        working_directory = '.',
+
+        argv = None,
+        ):
+
+    compiler_env = _default_compiler_env(compiler_env, executor_env)
+
+    if executor_env is None:
+        executor_env = ExecutorEnvironment(
+                compiler_env = compiler_env,
+                bytes_mode = compiler_env.bytes_mode,
+                )
+
+    elif executor_env.compiler_env is None:
+        executor_env.compiler_env = compiler_env
+
+    # --- compile template ---
+
+    # compiling changes the state of its environment, compiler_env may be
+    # shared by concurrent renders (e.g. of render_async).
+    compile_env = compiler_env.clone()
+
+    # template is a file name or a file object
+    if isinstance(template, str):
+        file_name = __realpath(template)
+
+        code_object = _load_code_file(
+                file_name,
+                executor_env.cache_folder_path,
+                compile_env,
+                )[1]
+
+    else:
+        file_name = template.name
+
+        code_object = _compile_file(template, compile_env)
+
+    buffer_type = io.BytesIO if compiler_env.bytes_mode else io.StringIO
+
+    # --- base variables ---
+
+    executor = _Executor(executor_env)
+
+    base_variables = dict(executor_env.variables)
+
+    executor.install(base_variables)
+
+    if argv is not None:
+        base_variables[executor_env.argv_variable_name] = argv
+        base_variables[executor_env.command_variable_name] = ' '.join(argv)
+
+    outfile_variable_name = executor_env.outfile_variable_name
+    pipes_varaible_name = executor_env.pipes_varaible_name
+
+    # --- render function ---
+
+    def render(variables = None, outfile = None):
+
+        if outfile is None:
+            with buffer_type() as string_buffer:
+                render(variables, string_buffer)
+                return string_buffer.getvalue()
+
+        # --- static files ---
+
+        if code_object is None:
+            _write_file(file_name, outfile)
+            return
+
+        if isinstance(code_object, (str, bytes)):
+            outfile.write(code_object)
+            return
+
+        # --- execute ---
+
+        namespace = base_variables.copy()
+
+        if variables:
+            namespace.update(variables)
+
+        pipes = collections.defaultdict(buffer_type)
+        pipes[None] = outfile
+
+        namespace[outfile_variable_name] = outfile
+        namespace[pipes_varaible_name] = pipes
+
+        executor.reset(
+                outfile,
+                pipes,
+                namespace,
+                file_name,
+                working_directory,
+                )
+
+        _exec_code_object(code_object, namespace)
+
+    return render
+
+# --- chunked output ---
+
+# _ChunkOutput collects written text, and hands it to send(chunk) in chunks
+# of at least chunk_size, so a consumer gets output while the template is
+# still rendering. close() sends the rest.
+
+class _ChunkOutput:
+
+    def __init__(self, send, chunk_size = _DEFAULT_OUTPUT_CHUNK_SIZE):
+        self.send = send
+        self.chunk_size = chunk_size
+
+        self.parts = []
+        self.size = 0
+
+        self.closed = False
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+
+        if self.size >= self.chunk_size:
+            self.send_parts()
+
+        return len(text)
+
+    def send_parts(self):
+        chunk = self.empty.join(self.parts)
+
+        self.parts = []
+        self.size = 0
+
+        self.send(chunk)
+
+    # chunks are sent by size, so a flush (e.g. before '__run__') doesn't
+    # send a small chunk.
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+
+            if self.parts:
+                self.send_parts()
+
+    empty = ''
+
+class _BinaryChunkOutput(_ChunkOutput):
+    empty = b''
+
+# static files are copied to it as bytes
+io.BufferedIOBase.register(_BinaryChunkOutput)
+
+def _chunk_output(binary, send, chunk_size):
+    if binary:
+        return _BinaryChunkOutput(send, chunk_size)
+
+    return _ChunkOutput(send, chunk_size)
+
+# --- streaming render ---
+
+# render_iter() is a generator that yields output chunks of a template, while
+# it renders in a background thread. the render waits if max_chunks chunks
+# are not consumed yet, so memory is bounded by chunk_size * max_chunks.
+# errors of the render are raised by the generator, and closing the generator
+# stops the render at its next chunk. compiler_env may be shared by
+# concurrent calls, since compile_template() compiles with a copy of it.
+#
+#   for chunk in render_iter('page.html', variables):
+#       connection.send(chunk.encode())
+
+class _RenderCancelled(Exception):
+    pass
+
+class _RenderFailure:
+    def __init__(self, error):
+        self.error = error
+
+def render_iter(
+        template,
+        variables = None,
+
+        compiler_env = None,
+        executor_env = None,
+
+        working_directory = '.',
+
+        argv = None,
+
+        chunk_size = _DEFAULT_OUTPUT_CHUNK_SIZE,
+        max_chunks = _DEFAULT_PENDING_CHUNKS,
+        ):
+
+    compiler_env = _default_compiler_env(compiler_env, executor_env)
+
+    render = compile_template(
+            template,
+            compiler_env,
+            executor_env,
+            working_directory,
+            argv,
+            )
+
+    chunks = queue.Queue(max_chunks)
+    cancelled = threading.Event()
+
+    def send(chunk):
+        if cancelled.is_set():
+            raise _RenderCancelled()
+
+        chunks.put(chunk)
+
+    def render_chunks():
+        try:
+            outfile = _chunk_output(compiler_env.bytes_mode, send, chunk_size)
+            render(variables, outfile)
+            outfile.close()
+
+        except _RenderCancelled:
+            return
+
+        except BaseException as e:
+            chunks.put(_RenderFailure(e))
+            return
+
+        # end of output
+        chunks.put(None)
+
+    thread = threading.Thread(target = render_chunks, daemon = True)
+    thread.start()
+
+    try:
+        while True:
+            chunk = chunks.get()
+
+            if chunk is None:
+                break
+
+            if isinstance(chunk, _RenderFailure):
+                raise chunk.error
+
+            yield chunk
+
+    finally:
+
+        # --- stop the render ---
+
+        cancelled.set()
+
+        while thread.is_alive():
+            try:
+                chunks.get_nowait()
+
+            except queue.Empty:
+                thread.join(0.01)
+
+# --- asyncio ---
+
+# render_async() compiles & renders a template without blocking the event
+# loop: cache & file I/O, compiling and executing run in executor (the
+# default executor of the loop if None), while commands of '__run__' run as
+# asyncio subprocesses on the loop.
+#
+# output is returned as str (bytes in bytes mode) if writer is None.
+# otherwise it's sent to writer in chunks of chunk_size, where writer is an
+# asyncio.StreamWriter or a coroutine function called with each chunk. the
+# render waits for each chunk to be written, so memory is bounded by
+# chunk_size.
+#
+# NOTE: commands of executor_env (if given) are run by its run_process.
+
+async def render_async(
+        template,
+        variables = None,
+        writer = None,
+
+        compiler_env = None,
+        executor_env = None,
+
+        working_directory = '.',
+
+        argv = None,
+
+        chunk_size = _DEFAULT_OUTPUT_CHUNK_SIZE,
+        executor = None,
+        ):
+
+    loop = asyncio.get_running_loop()
+
+    compiler_env = _default_compiler_env(compiler_env, executor_env)
+
+    own_executor_env = executor_env is None
+
+    if own_executor_env:
+        executor_env = ExecutorEnvironment(
+                compiler_env = compiler_env,
+                bytes_mode = compiler_env.bytes_mode,
+                run_process = _async_run_process(loop),
+                )
+
+    try:
+        render = await loop.run_in_executor(
+                executor,
+                compile_template,
+                template,
+                compiler_env,
+                executor_env,
+                working_directory,
+                argv,
+                )
 
-    variables[env.place_function_name] = _place_function
+        if writer is None:
+            return await loop.run_in_executor(executor, render, variables)
 
-    # --- include function ---
+        def send(chunk):
+            asyncio.run_coroutine_threadsafe(
+                    _write_chunk(writer, chunk),
+                    loop,
+                    ).result()
 
-    # TODO: write _include_function
+        def render_chunks():
+            outfile = _chunk_output(compiler_env.bytes_mode, send, chunk_size)
+            render(variables, outfile)
+            outfile.close()
 
-    # --- run function ---
+        await loop.run_in_executor(executor, render_chunks)
 
-    def _run_function(command,
-            stdin = None,
-            stdout = None,
-            stderr = None,
-            check = True
-            ):
+    finally:
+        if own_executor_env:
+            await loop.run_in_executor(executor, executor_env.close)
 
-        if stdin is None:
-            _input = ''
+async def _write_chunk(writer, chunk):
+    if isinstance(writer, asyncio.StreamWriter):
+        writer.write(chunk)
+        await writer.drain()
 
-        elif isinstance(stdin, (str, int)):
-            _input = pipes[stdin].getvalue()
+    else:
+        await writer(chunk)
 
-        else:
-            raise TypeError(
-                    "run stdin argument must be type of str or int")
+# returns a run_process function for ExecutorEnvironment, which runs commands
+# as asyncio subprocesses on loop. it must be called outside of loop thread.
 
-        if stdout is None or isinstance(stdout, (str, int)):
-            stdout = pipes[stdout]
-        else:
-            raise TypeError(
-                    "run stdout argument must be None or type of str or int")
+def _async_run_process(loop):
 
-        if stderr is None or isinstance(stderr, (str, int)):
-            stderr = pipes[stderr]
-        else:
-            raise TypeError(
-                    "run stderr argument must be None or type of str or int")
+    def run_process(command, _input, binary):
+        return asyncio.run_coroutine_threadsafe(
+                _run_process_async(command, _input, binary),
+                loop,
+                ).result()
 
-        outfile.flush()
+    return run_process
 
-        subprocess.run(
+async def _run_process_async(command, _input, binary):
+    if isinstance(command, str):
+        process = await asyncio.create_subprocess_shell(
                 command,
-                input = _input,
-                stdout = stdout,
-                stderr = stderr,
-                check = check,
-                shell = True,
-        )
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE,
+                )
 
-    variables[env.run_function_name] = _run_function
+    else:
+        process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE,
+                )
 
-    # --- load function ---
-    # load json file and update variables, same as '-l, --load JSONFILE'
-    # option.
+    if not binary:
+        _input = _input.encode(locale.getpreferredencoding(False))
 
-    # TODO: write _load_function
+    stdout, stderr = await process.communicate(_input)
 
-    # --- executing code_object ---
+    if not binary:
+        stdout = _decode_process_output(stdout)
+        stderr = _decode_process_output(stderr)
+
+    return (process.returncode, stdout, stderr)
+
+# same as universal_newlines = True of subprocess
 
-    return exec(code_object, variables)
+def _decode_process_output(output):
+    return io.TextIOWrapper(
+            io.BytesIO(output),
+            encoding = locale.getpreferredencoding(False),
+            ).read()
 
 # --- config parser ---
 
@@ -2019,6 +5174,35 @@ def __apply_language(lang, compiler_env):
     for key, value in _language_specifications[lang].items():
         setattr(compiler_env, key, value)
 
+_boolean_values = {
+    '1': True, 'true': True, 'yes': True, 'on': True,
+    '0': False, 'false': False, 'no': False, 'off': False,
+}
+
+def __parse_boolean(value):
+    try:
+        return _boolean_values[value.lower()]
+
+    except KeyError:
+        raise ValueError('invalid boolean value: {!r}'.format(value))
+
+# parses sizes like '4096', '64k' or '1M'
+def __parse_size(value):
+    value = value.strip().lower()
+
+    suffix = value[-1:] if value[-1:] in _SIZE_SUFFIXES else ''
+
+    try:
+        size = int(value[:len(value) - len(suffix)]) * _SIZE_SUFFIXES[suffix]
+
+    except ValueError:
+        raise ValueError('invalid size: {!r}'.format(value))
+
+    if size <= 0:
+        raise ValueError('invalid size: {!r}'.format(value))
+
+    return size
+
 def __apply_settings(key, value, compiler_env):
     if key in ('mp', 'macro_prefix'):
         compiler_env.macro_prefix = value
@@ -2050,6 +5234,24 @@ def __apply_settings(key, value, compiler_env):
     elif key in ('es', 'evaluation_suffix'):
         compiler_env.evaluation_suffix = value
 
+    elif key in ('ii', 'inline_includes'):
+        compiler_env.inline_includes = __parse_boolean(value)
+
+    elif key in ('fm', 'function_mode'):
+        compiler_env.function_mode = __parse_boolean(value)
+
+    elif key in ('pe', 'partial_evaluation'):
+        compiler_env.partial_evaluation = __parse_boolean(value)
+
+    elif key in ('bm', 'bytes_mode'):
+        compiler_env.bytes_mode = __parse_boolean(value)
+
+    elif key in ('ck', 'chunk_size'):
+        compiler_env.chunk_size = __parse_size(value)
+
+    elif key in ('bk', 'bulk_mode'):
+        compiler_env.bulk_mode = __parse_boolean(value)
+
     else:
         raise KeyError('unknown keyword: {!r}'.format(key))
 
@@ -2059,12 +5261,11 @@ def __import_module(name, env):
     env.variables[name] = \
             importlib.__import__(name, env.variables, env.variables, (), 0)
 
-def __load_jsonfile(filename):
-    with open(file_name) as infile:
-        return json.load(infile)
-
 def __define_variable(name, value, env):
-    env.variables[name] = eval(variable)
+    env.variables[name] = eval(value)
+
+def __define_constant(name, value, compiler_env):
+    compiler_env.constants[name] = eval(value)
 
 def __undefine_variable(name, env):
 
@@ -2073,6 +5274,197 @@ def __undefine_variable(name, env):
     except KeyError:
         pass
 
+# creates the executor environment of execution-time jobs (imports, loaded
+# json files, defines & undefines)
+
+def __create_executor_env(options, compiler_env, cache_folder_path):
+    executor_env = ExecutorEnvironment(
+            compiler_env = compiler_env,
+            cache_folder_path = cache_folder_path,
+            bytes_mode = compiler_env.bytes_mode,
+            )
+
+    # --- execution-time jobs ---
+    for item in options.jobs:
+        if item[0] == _IMPORT_FLAG:
+
+            __import_module(item[1], executor_env)
+
+        elif item[0] == _JSONFILE_FLAG:
+
+            json_object = _load_json_file(item[1])
+            executor_env.variables.update(json_object)
+
+        elif item[0] == _DEFINE_FLAG:
+
+            __define_variable(*item[1], executor_env)
+
+        elif item[0] == _CONSTANT_FLAG:
+
+            # constants are also variables for statements &
+            # evaluations.
+            executor_env.variables[item[1][0]] = \
+                    compiler_env.constants[item[1][0]]
+
+        elif item[0] == _UNDEFINE_FLAG:
+
+            __undefine_variable(item[1], executor_env)
+
+    return executor_env
+
+# isolated inputs are rendered by a copy of base_variables and new pipes, as
+# render functions of compile_template() do.
+
+def __isolate_executor_env(executor_env, base_variables):
+    executor_env.variables = dict(base_variables)
+    executor_env.pipes = collections.defaultdict(
+            io.BytesIO if executor_env.bytes_mode else io.StringIO)
+
+# returns output file paths of input_items in outfolder, outputs are named
+# as their input files. returns None if an error is printed.
+
+def __get_output_paths(outfolder, input_items, force):
+    output_paths = []
+    names = set()
+
+    for item in input_items:
+        if not isinstance(item[1], str):
+            __print_error(
+                "can't write standard input to output folder '{}'".format(
+                    outfolder,
+                )
+            )
+            return None
+
+        name = __splitpath(item[2])[1]
+        output_path = __joinpath(outfolder, name)
+
+        if name in names:
+            __print_error(
+                "more than one input writes to '{}'".format(output_path)
+            )
+            return None
+
+        if not force and __exists(output_path):
+            __print_error(
+                "'{}' exists, use '-f' to overwrite it".format(output_path)
+            )
+            return None
+
+        names.add(name)
+        output_paths.append(output_path)
+
+    try:
+        os.makedirs(outfolder, exist_ok = True)
+
+    except OSError as e:
+        __print_error("can't create '{}': {}".format(outfolder, e.strerror))
+        return None
+
+    return output_paths
+
+# renders code_object to output_path, or copies real_path if code_object is
+# None. output is written to a temporary file that replaces output_path when
+# it's complete, so output_path is never half written.
+
+def __render_output_file(
+        code_object,
+        real_path,
+        output_path,
+
+        executor_env,
+        buffer_size,
+        argv,
+        ):
+
+    temp_path = '{}.{}.{}'.format(
+            output_path, os.getpid(), threading.get_ident())
+
+    try:
+        with open_output(
+                temp_path,
+                buffer_size = buffer_size,
+                binary = executor_env.bytes_mode,
+                ) as outfile:
+
+            if code_object is None:
+                _write_file(real_path, outfile)
+
+            else:
+                execute_code_object(
+                        code_object,
+                        outfile,
+                        executor_env,
+
+                        argv = argv,
+                        )
+
+        os.replace(temp_path, output_path)
+
+    except BaseException:
+        try:
+            os.remove(temp_path)
+
+        except FileNotFoundError:
+            pass
+
+        raise
+
+# returns Workers that render isolated code objects. workers are forked after
+# inputs are compiled and execution-time jobs ran, so they inherit the
+# imported modules & loaded variables of executor_env, instead of repeating
+# the jobs in each worker.
+
+def __create_render_workers(
+        compiler_env,
+        executor_env,
+        workers_number,
+        buffer_size,
+        argv,
+        ):
+
+    buffer_type = io.BytesIO if compiler_env.bytes_mode else io.StringIO
+
+    base_variables = dict(executor_env.variables)
+
+    def render_job(code_object):
+        __isolate_executor_env(executor_env, base_variables)
+
+        with buffer_type() as outfile:
+            execute_code_object(
+                    code_object,
+                    outfile,
+                    executor_env,
+
+                    argv = argv,
+                    )
+
+            return outfile.getvalue()
+
+    # writes the output file by itself, returns nothing
+    def render_file_job(code_object, real_path, output_path):
+        __isolate_executor_env(executor_env, base_variables)
+
+        __render_output_file(
+                code_object,
+                real_path,
+                output_path,
+
+                executor_env,
+                buffer_size,
+                argv,
+                )
+
+    return Workers(
+            {
+                'render': render_job,
+                'render_file': render_file_job,
+            },
+            workers_number,
+
+            finalizer = executor_env.close,
+            )
+
 if sys.platform.startswith('linux') or sys.platform.startswith('freebsd'):
     def __get_cache_file_path(cache_folder_path, file_real_path):
         parts = file_real_path.split(os.sep)
@@ -2094,22 +5486,20 @@ def __write_compiled_code_env(code_object, env, outfile):
     # --- writing to file ---
     outfile.write(_CACHE_FILE_MAGIC_NUMBER)
 
-    _write_string(outfile, env.macro_prefix)
-    _write_string(outfile, env.macro_suffix)
-
-    _write_string(outfile, env.statement_prefix)
-    _write_string(outfile, env.statement_suffix)
+    _write_marshal_object(outfile, env.cache_key())
+    _write_marshal_object(outfile, env.dependencies)
 
-    _write_string(outfile, env.comment_prefix)
-    _write_string(outfile, env.comment_suffix)
+    # code object, static text or None for passthrough files. chunks of a
+    # large template are written as their number and each chunk, so only one
+    # chunk is marshaled at a time.
+    if isinstance(code_object, tuple):
+        _write_marshal_object(outfile, len(code_object))
 
-    _write_string(outfile, env.variable_prefix)
-    _write_string(outfile, env.variable_suffix)
+        for chunk in code_object:
+            _write_marshal_object(outfile, chunk)
 
-    _write_string(outfile, env.evaluation_prefix)
-    _write_string(outfile, env.evaluation_suffix)
-
-    _write_code_object(outfile, code_object)
+    else:
+        _write_marshal_object(outfile, code_object)
 
 # may raise: FileStructError, EOFError, or those may raise by file.read
 
@@ -2118,27 +5508,51 @@ def __read_compiled_code(infile, env):
     if infile.read(len(_CACHE_FILE_MAGIC_NUMBER)) != _CACHE_FILE_MAGIC_NUMBER:
         raise FileStructError('file magic number mismatch')
 
-    if \
-            env.macro_prefix == _read_string(infile) and \
-            env.macro_suffix == _read_string(infile) and \
-            env.statement_prefix == _read_string(infile) and \
-            env.statement_suffix == _read_string(infile) and \
-            env.comment_prefix == _read_string(infile) and \
-            env.comment_suffix == _read_string(infile) and \
-            env.variable_prefix == _read_string(infile) and \
-            env.variable_suffix == _read_string(infile) and \
-            env.evaluation_prefix == _read_string(infile) and \
-            env.evaluation_suffix == _read_string(infile):
+    try:
+        if _read_marshal_object(infile) != env.cache_key():
+            raise FileStructError('cache key mismatch')
 
-        return _read_code_object(infile)
+        dependencies = [tuple(item) for item in _read_marshal_object(infile)]
 
-    return None
+    except (ValueError, TypeError):
+        raise FileStructError('invalid cache file header')
+
+    if not _check_dependencies(dependencies):
+        raise FileStructError('dependencies changed')
+
+    try:
+        code_object = _read_marshal_object(infile)
+
+        # number of chunks of a large template
+        if type(code_object) is int:
+            code_object = tuple(
+                _read_marshal_object(infile) for _ in range(code_object)
+            )
+
+    except (ValueError, TypeError):
+        raise FileStructError('invalid cache file object')
+
+    if isinstance(code_object, tuple):
+        valid = all(isinstance(chunk, types.CodeType) for chunk in code_object)
+
+    else:
+        valid = code_object is None or \
+                isinstance(code_object, (types.CodeType, str, bytes))
+
+    if not valid:
+        raise FileStructError("invalid object type returned by marshal "
+                "while reading code object")
+
+    env.dependencies = dependencies
+
+    return code_object
 
 # function below will call the following functions:
 #   os.stat
 #   open
 
-# this function will return compiled code object
+# this function will return compiled code object, static text, or None if
+# output is equal to the file.
 
 def __compile_code_file(code_path, cache_path, compiler_env):
     code_stat = os.stat(code_path)
@@ -2151,25 +5565,30 @@ def __compile_code_file(code_path, cache_path, compiler_env):
             # this also may raise FileNotFoundError
             with open(cache_path, 'rb') as cache_file:
 
-                # may raise FileStructError or EOFError
-                code_object = __read_compiled_code(cache_file, compiler_env)
-
-                # __read_compiled_code() return None if prefixes & suffixes
-                # mismatch.
-                if code_object is not None:
-                    return code_object
+                # may raise FileStructError or EOFError, also if cache key
+                # or dependencies mismatch.
+                return __read_compiled_code(cache_file, compiler_env)
 
     except (FileNotFoundError, EOFError, FileStructError):
         pass
 
     # compile the file
-    with open(code_path, 'rt') as code_file:
-        code_object = compile_file(code_file, compiler_env)
+    with compiler_env.open_template(code_path) as code_file:
+        code_object = _compile_file(code_file, compiler_env)
 
-    # cache the compiled code_object
-    with open(cache_path, 'wb') as cache_file:
+        if compiler_env.passthrough:
+            code_object = None
+
+    # cache the compiled code_object, through a temporary file, so
+    # concurrent compiles never read a half written cache file.
+    temp_path = '{}.{}.{}'.format(
+            cache_path, os.getpid(), threading.get_ident())
+
+    with open(temp_path, 'wb') as cache_file:
         __write_compiled_code_env(code_object, compiler_env, cache_file)
 
+    os.replace(temp_path, cache_path)
+
     # return the result
     return code_object
 
@@ -2194,6 +5613,129 @@ def __cache_code_file(
 
     return cache_file_path, code_object
 
+# compiled code objects of this process, so a file is compiled or read from
+# cache folder at most once, no matter how many times it is included.
+
+_code_objects = {}
+
+def _load_code_file(
+        code_file_real_path,
+        cache_folder_path,
+        compiler_env,
+        ):
+
+    code_stat = os.stat(code_file_real_path)
+
+    cache_key = compiler_env.cache_key()
+
+    # code of custom code generators is never cached
+    if cache_key is None:
+        cache_folder_path = None
+
+    key = (
+            code_file_real_path,
+            code_stat.st_size,
+            code_stat.st_mtime_ns,
+            cache_key,
+        )
+
+    if cache_folder_path is None:
+        cache_file_path = None
+
+    else:
+        cache_file_path = __get_cache_file_path(
+                cache_folder_path,
+                code_file_real_path,
+                )
+
+    try:
+        if cache_key is not None:
+            code_object, dependencies = _code_objects[key]
+
+            if _check_dependencies(dependencies):
+                return cache_file_path, code_object
+
+    except KeyError:
+        pass
+
+    if cache_folder_path is None:
+        with compiler_env.open_template(code_file_real_path) as code_file:
+            code_object = _compile_file(code_file, compiler_env)
+
+            if compiler_env.passthrough:
+                code_object = None
+
+    else:
+        cache_file_path, code_object = __cache_code_file(
+                code_file_real_path,
+                cache_folder_path,
+                compiler_env,
+                )
+
+    if cache_key is not None:
+        _code_objects[key] = (code_object, compiler_env.dependencies)
+
+    return cache_file_path, code_object
+
+# --- compile pools ---
+
+# returns _THREAD_POOL, _PROCESS_POOL or None (compile in this thread) for
+# input files of the given sizes.
+
+def _choose_pool(sizes, workers):
+    if workers <= 1 or len(sizes) < _POOL_MIN_INPUTS:
+        return None
+
+    if sum(sizes) < _PROCESS_POOL_MIN_SIZE * len(sizes) or \
+            'fork' not in multiprocessing.get_all_start_methods():
+        return _THREAD_POOL
+
+    return _PROCESS_POOL
+
+# compiles input files of real_paths, returns a list of
+# (cache_file_path, code_object) in the same order. the first error is
+# raised, process workers are terminated by the first error that they find.
+
+def _compile_files(real_paths, cache_folder_path, compiler_env, workers):
+    sizes = [os.stat(real_path).st_size for real_path in real_paths]
+
+    pool = _choose_pool(sizes, workers)
+
+    if pool is None:
+        return [
+            _load_code_file(real_path, cache_folder_path, compiler_env.clone())
+            for real_path in real_paths
+        ]
+
+    config = compiler_env.config()
+    workers = min(workers, len(real_paths))
+
+    if pool == _THREAD_POOL:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(
+                lambda real_path: _load_code_file(
+                    real_path,
+                    cache_folder_path,
+                    config.environment(),
+                ),
+                real_paths,
+            ))
+
+    # the config is inherited by forked workers
+    def compile_job(real_path):
+        return _load_code_file(
+                real_path,
+                cache_folder_path,
+                config.environment(),
+                )
+
+    with Workers({'compile': compile_job}, workers) as pool:
+        return list(pool.map(
+            'compile',
+            [(real_path,) for real_path in real_paths],
+            sizes,
+        ))
+
 def __create_filter_ignore_files_function(
         name_filters,
         name_ignores,
@@ -2248,6 +5790,7 @@ def _main(argv):
     #           _IMPORT_FLAG                    execution-time job
     #           _JSONFILE_FLAG                  execution-time job
     #           _DEFINE_FLAG                    execution-time job
+    #           _CONSTANT_FLAG                  compile & execution-time job
     #           _UNDEFINE_FLAG                  execution-time job
 
     #   name_filters
@@ -2263,6 +5806,7 @@ def _main(argv):
     #           _CLEAR_CACHE_FLAG
     #           _FORCE_FLAG
     #           _DEREFERENCE_FLAG
+    #           _ISOLATE_FLAG
 
     #   output
     #       in (tup[0] for tup in options.output):
@@ -2393,16 +5937,21 @@ def _main(argv):
         compiler_env = CompilerEnvironment()
 
         # --- apply settings & languages ---
-        for item in (tup[1] for tup in options.jobs if tup[0] in
-                (_SETTING_FLAG, _LANG_FLAG)):
+        for job in options.jobs:
+            if job[0] == _SETTING_FLAG:
+                # job[1] is a [Key, Value]
+                __apply_settings(job[1][0].lower(), job[1][1], compiler_env)
 
-            if isinstance(item, tuple):
-                # item is a (Key, Value)
-                __apply_settings(item[0].lower(), item[1], compiler_env)
+            elif job[0] == _LANG_FLAG:
+                # job[1] is language specification
+                __apply_language(job[1], compiler_env)
 
-            else:
-                # item is language specification
-                __apply_language(item, compiler_env)
+            elif job[0] == _CONSTANT_FLAG:
+                # job[1] is a [Name, Value]
+                __define_constant(*job[1], compiler_env)
+
+        # --- compile regexes, before forking workers ---
+        compiler_env.matchers()
 
         # --- first compile the inputs ---
         if _MULTIPROCESSING_ENABLED:
@@ -2413,130 +5962,280 @@ def _main(argv):
         else:
 
             # --- compile and cache input FILEs ---
-            for item in options.jobs:
-                if item[0] == _INPUT_FLAG:
 
-                    # options.jobs contains:
-                    #   [_INPUT_FLAG, 'path', 'abs_path', 'real_path'] **
-                    #   [_INPUT_FLAG, sys.stdin]
+            file_items = [
+                item for item in options.jobs
+                if item[0] == _INPUT_FLAG and isinstance(item[1], str)
+            ]
 
-                    # ** filtered, ignored
+            input_items = [
+                item for item in options.jobs if item[0] == _INPUT_FLAG
+            ]
 
-                    if isinstance(item[1], str):
+            __compile_inputs(
+                    options,
+                    compiler_env,
+                    cache_folder_path,
+                    file_items,
+                    input_items,
+                    )
+
+            executor_env = None
+            workers = None
+
+            try:
+
+                # --- initialize executor environment ---
+
+                # execution-time jobs run once in this process, after inputs
+                # are compiled and before render workers are forked.
+                executor_env = __create_executor_env(
+                        options,
+                        compiler_env,
+                        cache_folder_path,
+                        )
+
+                # --- fork render workers ---
 
-                        # this function will return code_object, but we can
-                        # load cached file.
+                # isolated inputs don't share variables, so they are rendered
+                # by worker processes.
+                if _ISOLATE_FLAG & options.switchs and \
+                        min(options.workers, len(input_items)) > 1 and \
+                        'fork' in multiprocessing.get_all_start_methods():
 
-                        cache_file_path, code_object = \
-                            __cache_code_file(
-                                item[3],
-                                cache_folder_path,
-                                compiler_env,
+                    workers = __create_render_workers(
+                            compiler_env,
+                            executor_env,
+                            min(options.workers, len(input_items)),
+                            options.buffer_size,
+                            argv,
                             )
 
-                        item.append(cache_file_path)
-                        item.append(code_object)
+                return __render_inputs(
+                        options,
+                        compiler_env,
+                        executor_env,
+                        input_items,
+                        workers,
+                        argv,
+                        )
+
+            except BaseException:
+                if workers is not None:
+                    workers.terminate()
+                raise
+
+            finally:
+                if workers is not None:
+                    workers.close()
+
+                # --- stop coprocesses ---
+                if executor_env is not None:
+                    executor_env.close()
+
+def __compile_inputs(
+        options,
+        compiler_env,
+        cache_folder_path,
+        file_items,
+        input_items,
+        ):
+
+    # this function will return code objects, but we can load cached
+    # files.
+    results = _compile_files(
+            [item[3] for item in file_items],
+            cache_folder_path,
+            compiler_env,
+            options.workers,
+            )
 
-                    else: # item == [_INPUT_FLAG, sys.stdin]
+    for item, (cache_file_path, code_object) in \
+            zip(file_items, results):
 
-                        code_object = compile_file(sys.stdin, compiler_env)
+        item.append(cache_file_path)
+        item.append(code_object)
 
-                        item.append(code_object)
+    for item in input_items:
 
-                    # options.jobs contains:
-                    #   [_INPUT_FLAG, 'path', 'abs_path', 'real_path',
-                    #       'cache_file_path', code_object] **
-                    #   [_INPUT_FLAG, sys.stdin, code_object]
+        # options.jobs contains:
+        #   [_INPUT_FLAG, 'path', 'abs_path', 'real_path',
+        #       'cache_file_path', code_object] **
+        #   [_INPUT_FLAG, sys.stdin]
 
-                    # ** filtered, ignored
+        # ** filtered, ignored
 
-            # TODO: write '--outfile', '--outfolder' functionality
+        # item == [_INPUT_FLAG, sys.stdin]
+        if not isinstance(item[1], str):
 
-            # --- initialize executor environment ---
-            executor_env = ExecutorEnvironment()
+            infile = sys.stdin
+            if compiler_env.bytes_mode:
+                infile = io.TextIOWrapper(
+                        sys.stdin.buffer,
+                        encoding = 'latin-1',
+                        newline = '',
+                        )
 
-            # --- execution-time jobs ---
-            for item in options.jobs:
-                if item[0] == _IMPORT_FLAG:
+            code_object = _compile_file(infile, compiler_env)
 
-                    __import_module(item[1], executor_env)
+            item.append(code_object)
 
-                elif item[0] == _JSONFILE_FLAG:
+        # options.jobs contains:
+        #   [_INPUT_FLAG, 'path', 'abs_path', 'real_path',
+        #       'cache_file_path', code_object] **
+        #   [_INPUT_FLAG, sys.stdin, code_object]
 
-                    json_object = __load_jsonfile(item[1])
-                    executor_env.variables.update(json_object)
+        # ** filtered, ignored
 
-                elif item[0] == _DEFINE_FLAG:
+def __render_inputs(
+        options,
+        compiler_env,
+        executor_env,
+        input_items,
+        workers,
+        argv,
+        ):
 
-                    __define_variable(*item[1], executor_env)
+    # sizes of templates, workers take the largest ones first
+    if workers is not None:
+        sizes = [
+            os.stat(item[3]).st_size if isinstance(item[1], str) else 0
+            for item in input_items
+        ]
 
-                elif item[0] == _UNDEFINE_FLAG:
+    base_variables = dict(executor_env.variables)
 
-                    __undefine_variable(item[1], executor_env)
+    close_outfile = False
+    output_paths = None
 
-            if options.output is None:
+    # output of bytes mode is binary
+    if options.output is None:
 
-                outfile = sys.stdout
-                close_outfile = True
+        outfile = open_output(
+                buffer_size = options.buffer_size,
+                binary = compiler_env.bytes_mode,
+                )
 
-            elif options.output[0] == _OUTFILE_FLAG:
+        close_outfile = True
 
-                try:
-                    outfile = open(options.output[1], 'wt')
+    elif options.output[0] == _OUTFILE_FLAG:
 
-                except IsADirectoryError as e:
-                    __print_error(
-                        "can't open '{}': {}".format(
-                            options.output[1],
-                            e.args[0],
-                        )
+        try:
+            outfile = open_output(
+                    options.output[1],
+                    buffer_size = options.buffer_size,
+                    binary = compiler_env.bytes_mode,
                     )
-                    return EXIT_ERROR
 
-                close_outfile = True
+        except IsADirectoryError as e:
+            __print_error(
+                "can't open '{}': {}".format(
+                    options.output[1],
+                    e.args[0],
+                )
+            )
+            return EXIT_ERROR
 
-            elif options.output[0] == _OUTFOLDER_FLAG:
+        close_outfile = True
 
-                # TODO: complete _OUTFOLDER_FLAG
-                raise FatalError('unimplemented code')
+    elif options.output[0] == _OUTFOLDER_FLAG:
+
+        output_paths = __get_output_paths(
+                options.output[1],
+                input_items,
+                _FORCE_FLAG & options.switchs,
+                )
 
-            for item in options.jobs:
-                if item[0] == _INPUT_FLAG:
+        if output_paths is None:
+            return EXIT_ERROR
 
-                    # options.jobs contains:
-                    #   [_INPUT_FLAG, 'path', 'abs_path', 'real_path',
-                    #       'cache_file_path', code_object] **
-                    #   [_INPUT_FLAG, sys.stdin, code_object]
+    try:
 
-                    # ** filtered, ignored
+        # --- render to output folder ---
 
-                    if isinstance(item[1], str):
+        # each input is rendered to its output file, by workers directly,
+        # so outputs are never sent back to this process.
+        if output_paths is not None:
+            jobs = [
+                (item[-1], item[3], output_path)
+                for item, output_path in zip(input_items, output_paths)
+            ]
 
-                        try:
-                            execute_code_object(
-                                code_object,
-                                outfile,
-                                executor_env,
+            if workers is not None:
+                for _ in workers.map('render_file', jobs, sizes):
+                    pass
 
-                                argv = argv,
-                            )
-                        finally:
-                            if close_outfile:
-                                outfile.close()
+                return
 
-                    else: # item is [_INPUT_FLAG, sys.stdin, code_object]
+            for job in jobs:
+                if _ISOLATE_FLAG & options.switchs:
+                    __isolate_executor_env(executor_env, base_variables)
 
-                        try:
-                            execute_code_object(
-                                item[2],
-                                outfile,
-                                executor_env,
+                __render_output_file(
+                        *job,
+                        executor_env,
+                        options.buffer_size,
+                        argv,
+                        )
 
-                                argv = argv,
-                            )
-                        finally:
-                            if close_outfile:
-                                outfile.close()
+            return
+
+        # --- render by workers ---
+
+        # outputs are written in the order of inputs, as soon as outputs
+        # of previous inputs are written.
+        if workers is not None:
+            render_items = [
+                item for item in input_items if item[-1] is not None
+            ]
+
+            outputs = workers.map(
+                    'render',
+                    [(item[-1],) for item in render_items],
+                    [
+                        size for item, size in zip(input_items, sizes)
+                        if item[-1] is not None
+                    ],
+                    )
+
+            for item in input_items:
+                if item[-1] is None:
+                    _write_file(item[3], outfile)
+
+                else:
+                    outfile.write(next(outputs))
+
+            return
+
+        for item in input_items:
+
+            # options.jobs contains:
+            #   [_INPUT_FLAG, 'path', 'abs_path', 'real_path',
+            #       'cache_file_path', code_object] **
+            #   [_INPUT_FLAG, sys.stdin, code_object]
+
+            # ** filtered, ignored
+
+            # code_object is None if output is equal to the
+            # input file.
+            if item[-1] is None:
+                _write_file(item[3], outfile)
+
+            else:
+                if _ISOLATE_FLAG & options.switchs:
+                    __isolate_executor_env(executor_env, base_variables)
+
+                execute_code_object(
+                    item[-1],
+                    outfile,
+                    executor_env,
+
+                    argv = argv,
+                )
+
+    finally:
+        if close_outfile:
+            outfile.close()
 
 def main(argv):
     return _main(argv)
@@ -2550,6 +6249,7 @@ __all__ = [
         "FatalError",
         "FileStructError",
         "CompilerError",
+        "ExecutorError",
 
         # exit errors
         "EXIT_ERROR",
@@ -2569,7 +6269,11 @@ __all__ = [
         "MarshalQueue",
         "PickleQueue",
 
+        # worker processes
+        "Workers",
+
         # compiler environment
+        "CompilerConfig",
         "CompilerEnvironment",
 
         # compiler functions
@@ -2583,6 +6287,16 @@ __all__ = [
         # executor functions
         "execute_code_object",
 
+        # output files
+        "open_output",
+
+        # compiled templates
+        "compile_template",
+
+        # streaming & asyncio
+        "render_iter",
+        "render_async",
+
         # main function
         "main",
 